@@ -0,0 +1,463 @@
+#!/usr/bin/env python
+
+'''
+bench.py: Measure s3bdbk backup, restore and cleanup throughput.
+
+Synthetic devices are backed up to, restored from and cleaned up in a
+local directory store, through a stand-in for remote storage which
+adds latency, limits bandwidth and fails requests on demand.  With
+--s3-endpoint, the same scenarios also run against an S3 compatible
+service, like a local minio or moto server.  Each scenario runs in its
+own process, so that its peak memory use can be measured.
+'''
+
+# Copyright 2011-2015 Josh Pieper, jjp@pobox.com
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import collections
+import json
+import math
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import s3bdbk
+
+# Synthetic devices are written in pieces of this size.
+_WRITE_SIZE = 2**20
+
+# S3 returns at most this many names from one listing request, and
+# deletes at most this many in one request.
+_S3_PAGE_SIZE = 1000
+
+
+class ThrottledReader(object):
+    '''Passes through reads from another file-like object, with the
+    data crossing a SimulatedStorage link.'''
+    def __init__(self, source, storage):
+        self._source = source
+        self._storage = storage
+
+    def read(self, size=-1):
+        result = self._source.read(size)
+        self._storage.transfer(len(result))
+        return result
+
+    def close(self):
+        self._source.close()
+
+
+class SimulatedStorage(object):
+    '''Wraps another storage backend as if it were remote.  Each
+    request waits for latency seconds, and fails with probability
+    error_rate.  All transfers share one link of bandwidth bytes per
+    second, if given.  Requests are counted as S3 would count them,
+    along with the bytes sent and received.'''
+
+    def __init__(self, storage, latency=0.0, bandwidth=None, error_rate=0.0,
+                 seed=0):
+        self._storage = storage
+        self._latency = latency
+        self._bandwidth = bandwidth
+        self._error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._link_free = time.time()
+        self.prefix = storage.prefix
+        self.location = storage.location
+        self.requests = collections.defaultdict(int)
+        self.sent = 0
+        self.received = 0
+
+    def _request(self, method, count=1):
+        with self._lock:
+            self.requests[method] += count
+            fail = self._random.random() < self._error_rate
+        if self._latency:
+            time.sleep(self._latency * count)
+        if fail:
+            raise IOError('injected failure of %s' % method)
+
+    def transfer(self, size):
+        '''Wait for size bytes to cross the link, which carries one
+        transfer at a time.'''
+        if not self._bandwidth:
+            return
+        with self._lock:
+            start = max(time.time(), self._link_free)
+            self._link_free = start + float(size) / self._bandwidth
+            wait = self._link_free - time.time()
+        if wait > 0:
+            time.sleep(wait)
+
+    def exists(self, name):
+        self._request('exists')
+        return self._storage.exists(name)
+
+    def store(self, name, data, progress_function=None):
+        self._request('store')
+        self.transfer(len(data))
+        with self._lock:
+            self.sent += len(data)
+        self._storage.store(name, data)
+
+    def store_stream(self, name, stream, progress_function=None):
+        self._request('store')
+        reader = ThrottledReader(s3bdbk.TimedReader(stream), self)
+        self._storage.store_stream(name, reader)
+        with self._lock:
+            self.sent += reader._source.size
+
+    def load(self, name, progress_function=None):
+        self._request('load')
+        data = self._storage.load(name)
+        self.transfer(len(data))
+        with self._lock:
+            self.received += len(data)
+        return data
+
+    def load_stream(self, name):
+        self._request('load')
+        reader = s3bdbk.TimedReader(self._storage.load_stream(name))
+        storage = self
+
+        class Stream(ThrottledReader):
+            def close(self):
+                ThrottledReader.close(self)
+                with storage._lock:
+                    storage.received += reader.size
+
+        return Stream(reader, self)
+
+    def list(self, prefix):
+        result = self._storage.list(prefix)
+        self._request('list', max(1, int(math.ceil(
+                        len(result) / float(_S3_PAGE_SIZE)))))
+        return result
+
+    def list_sizes(self, prefix):
+        result = self._storage.list_sizes(prefix)
+        self._request('list', max(1, int(math.ceil(
+                        len(result) / float(_S3_PAGE_SIZE)))))
+        return result
+
+    def remove(self, name):
+        self._request('remove')
+        self._storage.remove(name)
+
+    def remove_many(self, names):
+        names = list(names)
+        self._request('remove', int(math.ceil(
+                    len(names) / float(_S3_PAGE_SIZE))))
+        return self._storage.remove_many(names)
+
+    def sync(self):
+        self._storage.sync()
+
+
+def random_bytes(rng, count):
+    '''Return count bytes from the random.Random rng.'''
+    if count <= 0:
+        return ''
+    return ('%0*x' % (2 * count, rng.getrandbits(8 * count))).decode('hex')
+
+def write_data(f, size, compressibility, rng):
+    '''Write size bytes of which about the compressibility fraction
+    will compress away.  The same rng state writes the same bytes.'''
+    while size > 0:
+        count = min(size, _WRITE_SIZE)
+        random_size = int(count * (1.0 - compressibility))
+        pattern = random_bytes(rng, 64)
+        f.write(random_bytes(rng, random_size) +
+                (pattern * (count / 64 + 1))[:count - random_size])
+        size -= count
+
+def make_device(path, size, block_size, zero_fraction=0.0,
+                compressibility=0.5, seed=0):
+    '''Create a synthetic device of size bytes.  About zero_fraction
+    of its blocks are left as holes, and the rest are random data of
+    which about the compressibility fraction compresses away.'''
+    rng = random.Random(seed)
+    f = open(path, 'wb')
+    f.truncate(size)
+    for offset in range(0, size, block_size):
+        length = min(block_size, size - offset)
+        if rng.random() < zero_fraction:
+            continue
+        f.seek(offset)
+        write_data(f, length, compressibility, rng)
+    f.close()
+
+def change_device(path, block_size, change_rate, compressibility=0.5,
+                  seed=1):
+    '''Rewrite about the change_rate fraction of the blocks of a
+    synthetic device.'''
+    rng = random.Random(seed)
+    size = os.path.getsize(path)
+    f = open(path, 'r+b')
+    for offset in range(0, size, block_size):
+        if rng.random() < change_rate:
+            f.seek(offset)
+            write_data(f, min(block_size, size - offset), compressibility,
+                       rng)
+    f.close()
+
+
+class Backend(object):
+    '''Creates the storage a scenario runs against, and the arguments
+    s3bdbk is run with.'''
+    def __init__(self, name, options, base_argv):
+        self.name = name
+        self._options = options
+        self._base_argv = base_argv
+
+    def parse_args(self, *argv):
+        args, extra = s3bdbk.make_parser().parse_args(
+            self._base_argv + list(self._options.extra) + list(argv))
+        return args
+
+    def make_storage(self, args):
+        options = self._options
+        if self.name == 's3':
+            # The service supplies its own latency and bandwidth.
+            return SimulatedStorage(s3bdbk.make_storage(args))
+        return SimulatedStorage(
+            s3bdbk.make_storage(args), options.latency,
+            options.bandwidth and s3bdbk.parse_size(options.bandwidth),
+            options.error_rate)
+
+
+def run_child(results, function):
+    devnull = open(os.devnull, 'w')
+    sys.stdout = devnull
+    try:
+        result = function()
+        result['error'] = None
+    except Exception, e:
+        result = {'error': '%s: %s' % (e.__class__.__name__, e)}
+    result['peak_rss'] = (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+    results.put(result)
+
+def run_isolated(function):
+    '''Run function in its own process, returning the dictionary it
+    returns with its peak resident set size added.'''
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run_child,
+                                      args=(results, function))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+def run_scenarios(options, backend, workdir):
+    '''Run each scenario in turn against backend, returning a list of
+    result dictionaries.'''
+    block_size = s3bdbk.parse_size(options.block_size)
+    size = s3bdbk.parse_size(options.size)
+    device = os.path.join(workdir, 'device')
+    restored = os.path.join(workdir, 'restored')
+    make_device(device, size, block_size, options.zero_fraction,
+                options.compressibility, options.seed)
+
+    def operation(function, argv, bytes_function=lambda: size):
+        def run():
+            s3bdbk._BLOCK_SIZE = block_size
+            args = backend.parse_args(*argv)
+            storage = backend.make_storage(args)
+            start = time.time()
+            result = function(args, storage)
+            if result not in (0, None):
+                raise RuntimeError('returned %r' % result)
+            return {'seconds': time.time() - start,
+                    'bytes': bytes_function(),
+                    'requests': dict(storage.requests),
+                    'sent': storage.sent,
+                    'received': storage.received}
+        return run
+
+    def cleanup(args, storage):
+        # Forget the first backup, so that its changed blocks can go.
+        manifests = sorted(storage.list(storage.prefix + '-manifest-'))
+        storage.remove(manifests[0])
+        return s3bdbk.do_cleanup(storage, args)
+
+    scenarios = [
+        ('full backup', operation(s3bdbk.do_backup, ['-b', device])),
+        ('incremental backup', operation(
+                s3bdbk.do_backup, ['-b', device])),
+        ('restore', operation(s3bdbk.do_restore, ['-b', restored])),
+        ('restore over changes', operation(
+                s3bdbk.do_restore, ['-b', restored])),
+        ('cleanup', operation(cleanup, [], lambda: 0)),
+        ]
+
+    results = []
+    for name, function in scenarios:
+        if name == 'incremental backup':
+            change_device(device, block_size, options.change_rate,
+                          options.compressibility, options.seed + 1)
+        elif name == 'restore':
+            if os.path.exists(restored):
+                os.remove(restored)
+        elif name == 'restore over changes':
+            change_device(restored, block_size, options.change_rate,
+                          options.compressibility, options.seed + 2)
+
+        result = run_isolated(function)
+        result['scenario'] = name
+        result['backend'] = backend.name
+        if result['error'] is None and result['bytes'] and \
+                result['seconds'] > 0:
+            result['mb_per_second'] = (
+                result['bytes'] / 2.0**20 / result['seconds'])
+        results.append(result)
+    return results
+
+def format_results(results, baseline=None):
+    '''Return a table of results, comparing throughput with the
+    matching results in baseline, if given.'''
+    previous = {}
+    for result in baseline or []:
+        previous[(result['backend'], result['scenario'])] = result
+
+    lines = ['%-22s %-9s %9s %9s %9s %9s  %s' % (
+            'scenario', 'backend', 'seconds', 'MB/s', 'requests',
+            'rss MB', 'change')]
+    for result in results:
+        if result['error'] is not None:
+            lines.append('%-22s %-9s  failed: %s' % (
+                    result['scenario'], result['backend'], result['error']))
+            continue
+        change = ''
+        old = previous.get((result['backend'], result['scenario']))
+        if old is not None and old.get('mb_per_second') and \
+                result.get('mb_per_second'):
+            change = '%+.1f%%' % (
+                100.0 * (result['mb_per_second'] / old['mb_per_second'] - 1))
+        mb_per_second = result.get('mb_per_second')
+        lines.append('%-22s %-9s %9.2f %9s %9d %9.1f  %s' % (
+                result['scenario'], result['backend'], result['seconds'],
+                mb_per_second is not None and '%.1f' % mb_per_second or '-',
+                sum(result['requests'].itervalues()),
+                result['peak_rss'] / 2.0**20, change))
+    return '\n'.join(lines)
+
+def make_parser():
+    import optparse
+    parser = optparse.OptionParser(
+        description='Measure s3bdbk performance on synthetic devices.')
+    parser.add_option('--size', default='256M',
+                      help='size of the synthetic device (default %default)')
+    parser.add_option('--block-size', default=str(s3bdbk._BLOCK_SIZE),
+                      help='block size to back up with (default %default)')
+    parser.add_option('--change-rate', type='float', default=0.1,
+                      help='fraction of blocks changed between backups ' +
+                      '(default %default)')
+    parser.add_option('--zero-fraction', type='float', default=0.1,
+                      help='fraction of blocks which are holes ' +
+                      '(default %default)')
+    parser.add_option('--compressibility', type='float', default=0.5,
+                      help='fraction of each block which compresses ' +
+                      'away (default %default)')
+    parser.add_option('--seed', type='int', default=0)
+
+    parser.add_option('--latency', type='float', default=0.02,
+                      help='seconds added to each simulated request ' +
+                      '(default %default)')
+    parser.add_option('--bandwidth',
+                      help='bytes per second of the simulated link, ' +
+                      'like 100M (default unlimited)')
+    parser.add_option('--error-rate', type='float', default=0.0,
+                      help='fraction of simulated requests which fail ' +
+                      '(default %default)')
+
+    parser.add_option('--s3-endpoint',
+                      help='also run against the S3 compatible service ' +
+                      'at this URL')
+    parser.add_option('--bucket', default='s3bdbk-bench')
+    parser.add_option('--access', default='access')
+    parser.add_option('--secret', default='secret')
+
+    parser.add_option('-x', '--extra', action='append', default=[],
+                      help='pass an option to s3bdbk, like -x--codec=lz4')
+    parser.add_option('--workdir',
+                      help='directory for devices and the store ' +
+                      '(default a temporary directory)')
+    parser.add_option('--json', help='write the results to this file')
+    parser.add_option('--compare',
+                      help='compare with results written earlier by --json')
+    return parser
+
+def run_benchmark(options):
+    '''Run every scenario against each backend, and return the list
+    of results.'''
+    workdir = options.workdir or tempfile.mkdtemp(prefix='s3bdbk-bench-')
+    try:
+        backends = []
+        for name in ['directory', 's3']:
+            if name == 's3' and options.s3_endpoint is None:
+                continue
+            backend_dir = os.path.join(workdir, name)
+            os.makedirs(os.path.join(backend_dir, 'store'))
+            argv = ['--state-dir', os.path.join(backend_dir, 'state')]
+            if name == 'directory':
+                argv += ['-d', os.path.join(backend_dir, 'store', 'bench')]
+            else:
+                argv += ['--endpoint', options.s3_endpoint,
+                         '--bucket', options.bucket, '--prefix', 'bench',
+                         '--access', options.access,
+                         '--secret', options.secret]
+            backends.append((Backend(name, options, argv), backend_dir))
+
+        results = []
+        for backend, backend_dir in backends:
+            results.extend(run_scenarios(options, backend, backend_dir))
+        return results
+    finally:
+        if options.workdir is None:
+            shutil.rmtree(workdir)
+
+def main():
+    options, extra = make_parser().parse_args()
+    results = run_benchmark(options)
+
+    baseline = None
+    if options.compare:
+        baseline = json.load(open(options.compare))
+    print format_results(results, baseline)
+
+    if options.json:
+        f = open(options.json, 'w')
+        json.dump(results, f, indent=2)
+        f.close()
+    return any(x['error'] is not None for x in results) and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -31,37 +31,163 @@ reconstructed with a shell script if need be.
 # SOFTWARE.
 
 # TODO:
-#  * Verify everything was uploaded before updating the current file
 #  * Let configuration file location be specified
 #  * Verify SSL is being used
 
 
+import array
+import bisect
+import collections
+import contextlib
+import copy
 import cStringIO
 import datetime
+import errno
 import hashlib
-import glob
-import gzip
+import io
+import json
+import math
 import os
+import Queue
 import random
 import re
+import stat
 import sys
+import tempfile
+import threading
 import time
+import zlib
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 # The block size should be relatively large.  It can be deduced from
 # remote data, so it can be changed without limiting compatibility.
 #
-# For now, we default it to 32 megs, which is a tradeoff between
-# limiting the number of objects in the remote store, and how much we
-# have to stick in memory at a time.  (Each block is loaded entirely
-# into RAM).
+# For now, we default it to 32 megs, which limits the number of
+# objects in the remote store.  Blocks are streamed through memory in
+# pieces, so the block size does not determine how much RAM is used.
 _BLOCK_SIZE = 2**25 # 32Megs
 
-# If there are collisions in this hash function at a block level, data
-# will be corrupted.  Thus, it should be relatively strong.
-_HASH_FUNCTION = hashlib.sha224
+# Blocks are read, hashed, compressed and written in pieces of this
+# size.
+_CHUNK_SIZE = 2**20
+
+# A block being restored is checked before any of it is written, so
+# it is kept until then, up to this many bytes in RAM and the rest in
+# a temporary file.
+_RESTORE_SPOOL_MEMORY = 4 * 2**20
+
+# Large objects are uploaded to S3 in multiple parts of this size,
+# which must be at least 5 megs.  Each part being uploaded is held in
+# RAM.
+_PART_SIZE = 5 * 2**20
 
-# Versioning information associated with this script.
-_BACKUP_VERSION = '1.0'
+# If there are collisions in this hash function at a block level, data
+# will be corrupted.  Thus, it should be relatively strong.  Any
+# hashlib algorithm may be chosen with --hash, and this is the default.
+_DEFAULT_HASH = 'sha224'
+
+# With --tree-hash, blocks are hashed in leaves of this size, several
+# at once, and the leaf digests are then hashed together.
+_TREE_LEAF_SIZE = 2**20
+_DEFAULT_HASH_JOBS = 4
+
+# Content defined chunks are cut where a rolling sum over a window of
+# this many bytes falls below a threshold.  The device is scanned for
+# those places in pieces of _CDC_SCAN_SIZE, which are kept to be
+# hashed and stored rather than read again.
+_CDC_WINDOW = 32
+_CDC_SCAN_SIZE = 2**20
+
+# The default minimum, average and maximum content defined chunk
+# sizes.
+_DEFAULT_CHUNK_SIZES = '1M:4M:16M'
+
+# Blocks which are entirely zero are not stored at all, but appear in
+# manifests under this name.
+_ZERO_BLOCK_NAME = 'zero'
+
+# Python 2 does not provide the lseek whence values for finding the
+# holes in sparse files, nor fallocate() for punching them.  These
+# are the Linux values.
+_SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+_SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+_FALLOC_FL_KEEP_SIZE = 1
+_FALLOC_FL_PUNCH_HOLE = 2
+
+# Nor does it provide posix_fadvise(), which --direct-io uses to drop
+# pages it has read when O_DIRECT is not supported.
+_POSIX_FADV_DONTNEED = 4
+
+# The device is read into reusable buffers which start on a boundary
+# of this many bytes, and with O_DIRECT, reads start and end on one.
+_DIRECT_IO_ALIGNMENT = 4096
+
+# Codecs which cannot limit their output are fed compressed data in
+# pieces of this size.
+_DECOMPRESS_INPUT_SIZE = 2**12
+
+# In auto compression mode, the start of each chunk of a block is
+# compressed as a sample, and if the block does not appear to shrink
+# below this ratio, it is stored uncompressed instead.
+_AUTO_SAMPLE_SIZE = 2**12
+_AUTO_MAX_RATIO = 0.9
+
+# The default number of worker threads used to hash blocks, and to
+# compress and upload them.
+_DEFAULT_JOBS = 2
+_DEFAULT_UPLOAD_JOBS = 4
+
+# The default number of blocks downloaded at once during a restore
+# or scrub.
+_DEFAULT_PREFETCH = 4
+
+# By default, a scrub skips blocks verified by another within this
+# many days.
+_DEFAULT_SCRUB_INTERVAL = 30
+
+# The default number of bytes of decompressed blocks kept in memory
+# when reading parts of a backup.
+_DEFAULT_CACHE_SIZE = 2**27
+
+# The default number of manifests loaded at once during cleanup.
+_DEFAULT_MANIFEST_JOBS = 4
+
+# The default number of parts of one object uploaded at once.
+_DEFAULT_PART_JOBS = 2
+
+# The default number of connections to S3 open at once.  Each worker
+# using S3 holds one while it does so.
+_DEFAULT_CONNECTIONS = 16
+
+# In the sharded directory layout, data blocks are kept in
+# subdirectories of this one named by this many leading digits of
+# their hash.  Files written are synced in batches of
+# _SYNC_BATCH_SIZE.
+_SHARD_DIRECTORY = '_shards'
+_SHARD_DIGITS = 2
+_SYNC_BATCH_SIZE = 64
+
+# Objects are deleted from S3 in batches of at most this many, which
+# is the most one request may name, with several batches in flight
+# at once.
+_DELETE_BATCH_SIZE = 1000
+_DEFAULT_DELETE_JOBS = 4
+
+# Versioning information associated with this script.  Version 1
+# manifests, which are just a list of block names, can still be read,
+# and written with --manifest-version 1.  Those using only the
+# original positional layout and gzip are then marked 1.0, so that
+# older versions of this script can restore them.
+_BACKUP_VERSION = '2.0'
+_V1_BACKUP_VERSION = '1.1'
+_POSITIONAL_BACKUP_VERSION = '1.0'
 _S3BDBK_VERSION = '0.2'
 
 class Progress(object):
@@ -69,11 +195,16 @@ class Progress(object):
         self._verbose = args.verbose
         self._operation_name = operation_name
         self._start = time.time()
+        self._lock = threading.Lock()
 
     def update(self, count, total_bytes, current_task):
         if not self._verbose:
             return
 
+        with self._lock:
+            self._update(count, total_bytes, current_task)
+
+    def _update(self, count, total_bytes, current_task):
         if total_bytes == 0:
             complete = 0.0
             eta_string = '0:00:00'
@@ -93,13 +224,1170 @@ class Progress(object):
                 100.0 * complete, eta_string, current_task))
         sys.stdout.flush()
 
+
+class StageStats(object):
+    '''Totals for one stage of an operation, and a histogram of the
+    time taken for each block, in power of two milliseconds.'''
+    def __init__(self):
+        self.count = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.histogram = collections.defaultdict(int)
+
+    def add(self, seconds, size):
+        self.count += 1
+        self.bytes += size
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.histogram[max(0, math.frexp(seconds * 1000)[1])] += 1
+
+    def summary(self):
+        return collections.OrderedDict([
+                ('count', self.count),
+                ('bytes', self.bytes),
+                ('seconds', round(self.seconds, 6))])
+
+    def report(self):
+        result = self.summary()
+        result['max_seconds'] = round(self.max_seconds, 6)
+        result['bytes_per_second'] = (
+            self.seconds and int(self.bytes / self.seconds) or None)
+        result['histogram'] = [
+            collections.OrderedDict([('le_seconds', 0.001 * 2**bucket),
+                                     ('count', self.histogram[bucket])])
+            for bucket in sorted(self.histogram)]
+        return result
+
+
+class Stats(object):
+    '''Counts the time spent and bytes handled by each stage of an
+    operation.  Stage times are summed over all threads, so together
+    they may exceed the time taken.  If interval is given, a JSON line
+    of the totals so far is written to stderr at most that often.'''
+    def __init__(self, operation, interval=None):
+        self._operation = operation
+        self._interval = interval
+        self._start = self._last_log = time.time()
+        self._lock = threading.Lock()
+        self._stages = collections.OrderedDict()
+
+    def add(self, stage, seconds, size=0):
+        with self._lock:
+            if stage not in self._stages:
+                self._stages[stage] = StageStats()
+            self._stages[stage].add(seconds, size)
+            now = time.time()
+            if self._interval is not None and \
+                    now - self._last_log >= self._interval:
+                self._last_log = now
+                # One write under the lock, as print writes the
+                # newline separately, and lines could be interleaved.
+                sys.stderr.write(
+                    json.dumps(self._report(lambda x: x.summary())) + '\n')
+
+    def _report(self, stage_report):
+        return collections.OrderedDict([
+                ('operation', self._operation),
+                ('date', datetime.datetime.utcnow().isoformat()),
+                ('seconds', round(time.time() - self._start, 6)),
+                ('stages', collections.OrderedDict(
+                        (name, stage_report(stage))
+                        for name, stage in self._stages.iteritems()))])
+
+    def report(self):
+        with self._lock:
+            return self._report(lambda x: x.report())
+
+    def save(self, path):
+        f = open(path, 'w')
+        json.dump(self.report(), f, indent=2)
+        f.write('\n')
+        f.close()
+
+def open_stats(args, operation):
+    return Stats(operation, args.stats_interval)
+
+def save_stats(stats, args):
+    if args.stats_file is not None:
+        stats.save(args.stats_file)
+
+
+_STOP = object()
+
+class Pipeline(object):
+    '''Passes items through a series of stages, each serviced by its
+    own pool of worker threads and joined by bounded queues.
+
+    Each stage is a (function, num_workers) tuple.  A stage function
+    is called with one item and returns the item to hand to the next
+    stage, or None to drop it.  If any stage raises, the remaining
+    items are discarded and the first exception is re-raised from
+    run().'''
+
+    def __init__(self, stages):
+        self._stages = stages
+        self._queues = [Queue.Queue(maxsize=workers)
+                        for function, workers in stages]
+        self._remaining = [workers for function, workers in stages]
+        self._lock = threading.Lock()
+        self._abort = threading.Event()
+        self._error = None
+
+    def run(self, source):
+        '''Feed every item from the iterable source through all the
+        stages, and wait for them to complete.'''
+        threads = [threading.Thread(target=self._feed, args=(source,))]
+        for index, (function, workers) in enumerate(self._stages):
+            threads.extend([threading.Thread(target=self._work, args=(index,))
+                            for i in range(workers)])
+
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        for thread in threads:
+            # A join with no timeout would not let KeyboardInterrupt
+            # through.
+            while thread.is_alive():
+                thread.join(0.5)
+
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+
+    def _fail(self):
+        with self._lock:
+            if self._error is None:
+                self._error = sys.exc_info()
+        self._abort.set()
+
+    def _feed(self, source):
+        try:
+            for item in source:
+                if self._abort.is_set():
+                    break
+                self._queues[0].put(item)
+        except:
+            self._fail()
+        self._stop_stage(0)
+
+    def _work(self, index):
+        function = self._stages[index][0]
+        while True:
+            item = self._queues[index].get()
+            if item is _STOP:
+                break
+            if self._abort.is_set():
+                # Keep draining so that earlier stages never block.
+                continue
+            try:
+                result = function(item)
+            except:
+                self._fail()
+                continue
+            if result is not None and index + 1 < len(self._stages):
+                self._queues[index + 1].put(result)
+
+        with self._lock:
+            self._remaining[index] -= 1
+            last = self._remaining[index] == 0
+        if last and index + 1 < len(self._stages):
+            self._stop_stage(index + 1)
+
+    def _stop_stage(self, index):
+        for i in range(self._stages[index][1]):
+            self._queues[index].put(_STOP)
+
+
+class SharedSource(object):
+    '''The items one caller of SharedPipeline.run() passes through it,
+    and how many of them are still in flight.'''
+
+    def __init__(self, items, functions):
+        self.items = items
+        self.functions = functions
+        self.error = None
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._exhausted = False
+
+    def fail(self):
+        with self._lock:
+            if self.error is None:
+                self.error = sys.exc_info()
+
+    def add(self):
+        with self._lock:
+            self._pending += 1
+
+    def remove(self):
+        with self._lock:
+            self._pending -= 1
+            self._check()
+
+    def exhaust(self):
+        with self._lock:
+            self._exhausted = True
+            self._check()
+
+    def _check(self):
+        if self._exhausted and self._pending == 0:
+            self.done.set()
+
+
+class SharedPipeline(object):
+    '''A Pipeline whose workers are shared by several sources of items
+    at once, each with its own stage functions.  Items are taken from
+    each source in turn, so that all progress at the same rate however
+    many items each has.  An error stops only the source whose item
+    raised it.'''
+
+    def __init__(self, workers):
+        self._last = len(workers) - 1
+        self._condition = threading.Condition()
+        self._sources = collections.deque()
+        self._closed = False
+        pipeline = Pipeline([
+                (lambda entry, index=index: self._stage(index, entry), count)
+                for index, count in enumerate(workers)])
+        self._thread = threading.Thread(target=pipeline.run,
+                                        args=(self._items(),))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def run(self, items, functions):
+        '''Pass every item from the iterable items through functions,
+        one for each stage, and wait for them to complete.'''
+        source = SharedSource(iter(items), functions)
+        with self._condition:
+            self._sources.append(source)
+            self._condition.notify_all()
+        # A wait with no timeout would not let KeyboardInterrupt
+        # through.
+        while not source.done.wait(0.5):
+            pass
+        if source.error is not None:
+            raise source.error[0], source.error[1], source.error[2]
+
+    def close(self):
+        '''Stop the workers once every source has completed.'''
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        while self._thread.is_alive():
+            self._thread.join(0.5)
+
+    def _items(self):
+        while True:
+            with self._condition:
+                while not self._sources and not self._closed:
+                    self._condition.wait()
+                if not self._sources:
+                    return
+                source = self._sources.popleft()
+
+            item = _STOP
+            if source.error is None:
+                try:
+                    item = next(source.items)
+                except StopIteration:
+                    pass
+                except:
+                    source.fail()
+            if item is _STOP:
+                source.exhaust()
+                continue
+
+            source.add()
+            with self._condition:
+                self._sources.append(source)
+            yield source, item
+
+    def _stage(self, index, entry):
+        source, item = entry
+        result = None
+        if source.error is None:
+            try:
+                result = source.functions[index](item)
+            except:
+                source.fail()
+        if result is None or index == self._last:
+            source.remove()
+            return None
+        return source, result
+
+
+def map_ahead(function, items, workers, depth=None):
+    '''Yield function(item) for each item in turn, while up to depth
+    later calls run ahead on a pool of worker threads.'''
+    depth = max(depth or workers, workers)
+    tasks = Queue.Queue()
+    pending = collections.deque()
+
+    def work():
+        while True:
+            task = tasks.get()
+            if task is _STOP:
+                break
+            item, future = task
+            try:
+                future.put((function(item), None))
+            except:
+                future.put((None, sys.exc_info()))
+
+    def result(future):
+        value, error = future.get()
+        if error is not None:
+            raise error[0], error[1], error[2]
+        return value
+
+    threads = [threading.Thread(target=work) for i in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        for item in items:
+            future = Queue.Queue(1)
+            tasks.put((item, future))
+            pending.append(future)
+            if len(pending) >= depth:
+                yield result(pending.popleft())
+        while pending:
+            yield result(pending.popleft())
+    finally:
+        for thread in threads:
+            tasks.put(_STOP)
+        for thread in threads:
+            thread.join()
+
+
+_libc_functions = {}
+
+def get_libc_function(name, argtypes):
+    '''Return the named C library function, taking arguments of the
+    ctypes types returned by argtypes(ctypes), or None if there is not
+    one.'''
+    if name not in _libc_functions:
+        try:
+            import ctypes
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            function = getattr(libc, name)
+            function.argtypes = argtypes(ctypes)
+        except (ImportError, OSError, AttributeError):
+            function = None
+        _libc_functions[name] = function
+    return _libc_functions[name]
+
+def get_fallocate():
+    '''Return the C library's fallocate(), or None if there is not
+    one.'''
+    # fd, mode, offset, len
+    return get_libc_function('fallocate', lambda c: [
+        c.c_int, c.c_int, c.c_int64, c.c_int64])
+
+def get_posix_fadvise():
+    '''Return the C library's posix_fadvise(), or None if there is not
+    one.'''
+    # fd, offset, len, advice
+    return get_libc_function('posix_fadvise', lambda c: [
+        c.c_int, c.c_int64, c.c_int64, c.c_int])
+
+
+class AlignedBuffer(object):
+    '''Memory which a read of up to size bytes from any offset can be
+    made into, even with O_DIRECT.'''
+
+    def __init__(self, size):
+        import ctypes
+        self.size = size
+        # Room for a read to start a whole alignment early and finish
+        # one late, and to move the start onto a boundary.
+        self._data = bytearray(size + 3 * _DIRECT_IO_ALIGNMENT)
+        address = ctypes.addressof(ctypes.c_char.from_buffer(self._data))
+        self._start = -address % _DIRECT_IO_ALIGNMENT
+
+    def view(self, start, length):
+        '''Return a writable memoryview of length bytes, start bytes
+        after the aligned start.'''
+        start += self._start
+        return memoryview(self._data)[start:start + length]
+
+    def data(self, start, length):
+        '''Return a read-only view of length bytes, start bytes after
+        the aligned start.  Unlike a memoryview, every codec accepts
+        it.'''
+        return buffer(self._data, self._start + start, length)
+
+
+class BufferPool(object):
+    '''Reusable AlignedBuffers of size bytes.  A new one is made
+    whenever all are in use, so there are only ever as many as there
+    are readers at once.'''
+
+    def __init__(self, size):
+        self.size = size
+        self._lock = threading.Lock()
+        self._free = []
+
+    def acquire(self):
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+        return AlignedBuffer(self.size)
+
+    def release(self, buf):
+        with self._lock:
+            self._free.append(buf)
+
+
+class PositionalFile(object):
+    '''A file which is read and written at explicit offsets by many
+    threads at once.  Each thread gets its own file object, so that
+    their file positions never interfere.
+
+    With direct set, reads bypass the page cache, so that reading a
+    whole device once does not evict everything else cached.  Where
+    O_DIRECT is supported, reads into buffers use it, and otherwise
+    the pages are dropped again with posix_fadvise() once read.'''
+
+    def __init__(self, path, writable=False, direct=False):
+        if writable:
+            # Create the file once up front, so that later opens need
+            # no special flags.
+            os.close(os.open(path, os.O_RDWR | os.O_CREAT))
+        self._path = path
+        self._mode = writable and 'r+' or 'r'
+        self._direct = direct
+        self._o_direct = direct and hasattr(os, 'O_DIRECT')
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._files = []
+        self.buffers = BufferPool(_CHUNK_SIZE)
+
+    def _file(self):
+        result = getattr(self._local, 'file', None)
+        if result is None:
+            result = io.FileIO(self._path, self._mode)
+            self._local.file = result
+            with self._lock:
+                self._files.append(result)
+        return result
+
+    def _direct_file(self):
+        '''Return a file opened for reading with O_DIRECT, or None if
+        that is not supported here.'''
+        if not self._o_direct:
+            return None
+        result = getattr(self._local, 'direct_file', None)
+        if result is None:
+            try:
+                fd = os.open(self._path, os.O_RDONLY | os.O_DIRECT)
+            except OSError, e:
+                if e.errno != errno.EINVAL:
+                    raise
+                # This file system does not support O_DIRECT.
+                self._o_direct = False
+                return None
+            result = io.FileIO(fd, 'r')
+            self._local.direct_file = result
+            with self._lock:
+                self._files.append(result)
+        return result
+
+    def _drop_cache(self, f, offset, length):
+        if not self._direct:
+            return
+        fadvise = get_posix_fadvise()
+        if fadvise is not None:
+            # This returns the error number rather than setting errno.
+            result = fadvise(f.fileno(), offset, length, _POSIX_FADV_DONTNEED)
+            if result != 0:
+                raise OSError(result, os.strerror(result))
+
+    def size(self):
+        f = self._file()
+        f.seek(0, os.SEEK_END)
+        return f.tell()
+
+    def is_regular(self):
+        return stat.S_ISREG(os.fstat(self._file().fileno()).st_mode)
+
+    def extend(self, size):
+        '''Make a regular file at least size bytes long.'''
+        if self.is_regular() and self.size() < size:
+            self._file().truncate(size)
+
+    def is_hole(self, offset, length):
+        '''Whether the given region is known to be a hole in a sparse
+        file, and so reads as zeros.'''
+        if not hasattr(os, 'SEEK_DATA') and not sys.platform.startswith(
+            'linux'):
+            return False
+        try:
+            data = os.lseek(self._file().fileno(), offset, _SEEK_DATA)
+        except OSError, e:
+            # ENXIO means there is no more data in the file, anything
+            # else that holes are not supported here.
+            return e.errno == errno.ENXIO
+        return data >= offset + length
+
+    def punch_hole(self, offset, length):
+        '''Deallocate a region so that it reads as zeros, returning
+        False if that is not supported.'''
+        fallocate = get_fallocate()
+        if fallocate is None:
+            return False
+        return fallocate(self._file().fileno(),
+                         _FALLOC_FL_PUNCH_HOLE | _FALLOC_FL_KEEP_SIZE,
+                         offset, length) == 0
+
+    def is_zero(self, offset, length):
+        '''Whether the given region reads as zeros.'''
+        if self.is_hole(offset, length):
+            return True
+        zeros = '\0' * min(length, _CHUNK_SIZE)
+        reader = RegionReader(self, offset, length)
+        try:
+            while True:
+                data = reader.read(_CHUNK_SIZE)
+                if not data:
+                    return True
+                if not zeros.startswith(data):
+                    return False
+        finally:
+            reader.close()
+
+    def write_zeros(self, offset, length, check=True):
+        '''Make the given region read as zeros, doing nothing if check
+        is set and it already does.'''
+        if (check and self.is_zero(offset, length)) or \
+                self.punch_hole(offset, length):
+            return
+        zeros = '\0' * min(length, _CHUNK_SIZE)
+        while length > 0:
+            self.pwrite(offset, zeros[:length])
+            offset += len(zeros)
+            length -= len(zeros)
+
+    def pread(self, offset, length):
+        f = self._file()
+        f.seek(offset)
+        chunks = []
+        remaining = length
+        while remaining > 0:
+            chunk = f.read(remaining)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        self._drop_cache(f, offset, length)
+        return ''.join(chunks)
+
+    def read_into(self, offset, length, buf):
+        '''Read up to length bytes at offset into the AlignedBuffer
+        buf, returning a read-only view of those read.  No more than
+        buf.size bytes are read.'''
+        length = min(length, buf.size)
+        f = self._direct_file()
+        if f is None:
+            f = self._file()
+            start = offset
+            end = offset + length
+        else:
+            # O_DIRECT reads must start and end on boundaries.
+            start = offset - offset % _DIRECT_IO_ALIGNMENT
+            end = offset + length
+            end += -end % _DIRECT_IO_ALIGNMENT
+        f.seek(start)
+        view = buf.view(0, end - start)
+        count = 0
+        while count < len(view):
+            read = f.readinto(view[count:])
+            if not read:
+                break
+            count += read
+        self._drop_cache(f, start, end - start)
+        skip = offset - start
+        return buf.data(skip, max(0, min(count - skip, length)))
+
+    def pwrite(self, offset, data):
+        f = self._file()
+        f.seek(offset)
+        view = memoryview(data)
+        while len(view):
+            view = view[f.write(view):]
+
+    def close(self):
+        with self._lock:
+            for f in self._files:
+                f.close()
+            self._files = []
+
+
+class RegionReader(object):
+    '''A file-like view of length bytes of a PositionalFile, starting
+    at offset.
+
+    Reads are made into a buffer from the source's pool, and what is
+    returned is a view of that buffer, so it is only valid until the
+    next read.'''
+    def __init__(self, source, offset, length):
+        self._source = source
+        self._offset = offset
+        self._remaining = length
+        self._buffer = None
+
+    def read(self, size):
+        size = min(size, self._remaining)
+        if size <= 0:
+            self.close()
+            return ''
+        if self._buffer is None:
+            self._buffer = self._source.buffers.acquire()
+        size = min(size, self._buffer.size)
+        result = self._source.read_into(self._offset, size, self._buffer)
+        self._offset += len(result)
+        self._remaining -= len(result)
+        if len(result) < size:
+            # We hit the end of the file.
+            self._remaining = 0
+        return result
+
+    def close(self):
+        '''Return the buffer to the pool.'''
+        if self._buffer is not None:
+            self._source.buffers.release(self._buffer)
+            self._buffer = None
+
+
+class PiecesReader(object):
+    '''A file-like view of the concatenation of a list of strings or
+    buffers, which returns views of them rather than copies.'''
+    def __init__(self, pieces):
+        self._pieces = collections.deque(pieces)
+
+    def read(self, size):
+        while self._pieces and not len(self._pieces[0]):
+            self._pieces.popleft()
+        if not self._pieces:
+            return ''
+        piece = self._pieces[0]
+        if len(piece) <= size:
+            self._pieces.popleft()
+            return piece
+        self._pieces[0] = buffer(piece, size)
+        return buffer(piece, 0, size)
+
+    def close(self):
+        self._pieces.clear()
+
+
+def new_hash(name):
+    '''Return a new hashlib object for the named algorithm.  Before
+    Python 3.6, BLAKE2 is only available from pyblake2.'''
+    try:
+        return hashlib.new(name)
+    except ValueError:
+        if not name.startswith('blake2'):
+            raise
+        import pyblake2
+        return getattr(pyblake2, name)()
+
+
+# The worker threads for tree hashes, shared by every HashFunction
+# so that making one per backup or manifest does not leave threads
+# behind.  There are as many as the most workers any has asked for.
+_hash_lock = threading.Lock()
+_hash_tasks = Queue.Queue()
+_hash_threads = []
+
+def _hash_work():
+    while True:
+        name, data, future = _hash_tasks.get()
+        hasher = new_hash(name)
+        # hashlib releases the GIL while hashing large buffers.
+        hasher.update(data)
+        future.put(hasher.digest())
+
+
+class HashFunction(object):
+    '''A way of hashing blocks, which when called returns a new hash
+    object.  With a leaf_size, it is a tree hash, where each leaf of
+    that many bytes is hashed on one of a pool of worker threads, and
+    the leaf digests are hashed together in order.'''
+
+    def __init__(self, name, leaf_size=None, workers=_DEFAULT_HASH_JOBS):
+        self.name = name
+        self.leaf_size = leaf_size
+        self.digest_size = new_hash(name).digest_size
+        self.workers = workers
+
+    def __call__(self):
+        if self.leaf_size is None:
+            return new_hash(self.name)
+        return TreeHash(self)
+
+    def header(self):
+        '''Return the manifest header lines describing this hash.'''
+        result = 'Hash: %s\n' % self.name
+        if self.leaf_size is not None:
+            result += 'Hash-leaf-size: %d\n' % self.leaf_size
+        return result
+
+    def submit(self, data):
+        '''Start hashing data, and return a queue which will hold its
+        digest.'''
+        with _hash_lock:
+            while len(_hash_threads) < self.workers:
+                thread = threading.Thread(target=_hash_work)
+                thread.daemon = True
+                thread.start()
+                _hash_threads.append(thread)
+        future = Queue.Queue(1)
+        _hash_tasks.put((self.name, data, future))
+        return future
+
+def get_hash_function(args):
+    leaf_size = None
+    if args.tree_hash:
+        leaf_size = _TREE_LEAF_SIZE
+    return HashFunction(args.hash, leaf_size, args.hash_jobs)
+
+def get_manifest_hash_function(manifest, workers=_DEFAULT_HASH_JOBS):
+    '''Return the HashFunction which named the blocks of a manifest.'''
+    leaf_size = manifest.headers.get('Hash-leaf-size')
+    if leaf_size is not None:
+        leaf_size = int(leaf_size)
+    return HashFunction(manifest.headers.get('Hash', _DEFAULT_HASH),
+                        leaf_size, workers)
+
+
+class TreeHash(object):
+    '''A hash object for a tree HashFunction.'''
+
+    def __init__(self, function):
+        self._function = function
+        self._buffer = []
+        self._buffered = 0
+        self._pending = collections.deque()
+        self._digests = []
+        self._result = None
+
+    def update(self, data):
+        leaf_size = self._function.leaf_size
+        while data:
+            count = min(len(data), leaf_size - self._buffered)
+            self._buffer.append(data[:count])
+            self._buffered += count
+            data = data[count:]
+            if self._buffered == leaf_size:
+                self._submit()
+
+    def _submit(self):
+        self._pending.append(self._function.submit(''.join(self._buffer)))
+        self._buffer = []
+        self._buffered = 0
+        # Keep only a few leaves waiting, so memory stays bounded.
+        while len(self._pending) > 2 * self._function.workers:
+            self._digests.append(self._pending.popleft().get())
+
+    def hexdigest(self):
+        if self._result is None:
+            if self._buffered or not (self._pending or self._digests):
+                self._submit()
+            while self._pending:
+                self._digests.append(self._pending.popleft().get())
+            root = new_hash(self._function.name)
+            root.update(''.join(self._digests))
+            self._result = root.hexdigest()
+        return self._result
+
+
+class TimedReader(object):
+    '''Passes through reads from another file-like object, counting
+    the time spent in them and the bytes read.'''
+    def __init__(self, source):
+        self._source = source
+        self.elapsed = 0.0
+        self.size = 0
+
+    def read(self, size=-1):
+        start = time.time()
+        result = self._source.read(size)
+        self.elapsed += time.time() - start
+        self.size += len(result)
+        return result
+
+    def close(self):
+        self._source.close()
+
+
+class Throttle(object):
+    '''Limits the transfers of any number of threads together to rate
+    bytes per second.'''
+    def __init__(self, rate):
+        self._rate = float(rate)
+        self._lock = threading.Lock()
+        self._free = time.time()
+
+    def wait(self, size):
+        '''Wait until size more bytes fit within the rate.'''
+        with self._lock:
+            now = time.time()
+            self._free = max(now, self._free) + size / self._rate
+            delay = self._free - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+class ThrottledReader(object):
+    '''Passes through reads from another file-like object, no faster
+    than a Throttle allows.'''
+    def __init__(self, source, throttle):
+        self._source = source
+        self._throttle = throttle
+
+    def read(self, size=-1):
+        result = self._source.read(size)
+        self._throttle.wait(len(result))
+        return result
+
+    def close(self):
+        self._source.close()
+
+
+class HashingReader(object):
+    '''Passes through reads from another file-like object, hashing the
+    data as it goes.'''
+    def __init__(self, source, hash_function=None):
+        self._source = source
+        if hash_function is None:
+            self._hasher = new_hash(_DEFAULT_HASH)
+        else:
+            self._hasher = hash_function()
+        self.size = 0
+
+    def read(self, size):
+        result = self._source.read(size)
+        self._hasher.update(result)
+        self.size += len(result)
+        return result
+
+    def hexdigest(self):
+        return self._hasher.hexdigest()
+
+
+class CompressingReader(object):
+    '''A file-like object yielding the contents of another as passed
+    through a compressor, holding no more than a chunk of either in
+    memory.
+
+    What the compressor returns is passed on without copying, so a
+    read may return less than was asked for, and a view which is only
+    valid until the next read.'''
+    def __init__(self, source, compressor):
+        self._source = source
+        self._compressor = compressor
+        self._buffer = ''
+        self._done = False
+        self.size = 0
+
+    def read(self, size=-1):
+        if size < 0:
+            return ''.join(iter(lambda: str(self.read(_CHUNK_SIZE)), ''))
+
+        while not self._buffer and not self._done:
+            data = self._source.read(_CHUNK_SIZE)
+            if data:
+                self._buffer = self._compressor.compress(data)
+            else:
+                self._buffer = self._compressor.flush()
+                self._done = True
+
+        result = self._buffer
+        if len(result) > size:
+            result = buffer(self._buffer, 0, size)
+            self._buffer = buffer(self._buffer, size)
+        else:
+            self._buffer = ''
+        self.size += len(result)
+        return result
+
+
+def read_fully(source, size):
+    '''Read size bytes from the file-like object source, or as many as
+    remain, as a string, however few each read returns.'''
+    pieces = []
+    while size > 0:
+        data = source.read(size)
+        if not data:
+            break
+        pieces.append(str(data))
+        size -= len(data)
+    return ''.join(pieces)
+
+
+class DecompressingReader(object):
+    '''A file-like object yielding the decompressed contents of a gzip
+    stream, without ever decompressing more than is asked for.'''
+    def __init__(self, source):
+        self._source = source
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._done = False
+
+    def read(self, size):
+        while not self._done:
+            tail = self._decompressor.unconsumed_tail
+            if not tail:
+                tail = self._source.read(_CHUNK_SIZE)
+                if not tail:
+                    self._done = True
+                    return self._decompressor.flush()
+            result = self._decompressor.decompress(tail, size)
+            if result:
+                return result
+        return ''
+
+
+class ChunkedDecompressingReader(object):
+    '''A file-like object yielding the output of a decompressor which
+    cannot limit how much it produces.  Input is fed to it in small
+    pieces to keep the output of each step small, although highly
+    compressed data can still produce a lot at once.'''
+    def __init__(self, source, decompressor):
+        self._source = source
+        self._decompressor = decompressor
+        self._buffer = ''
+
+    def read(self, size):
+        while not self._buffer:
+            data = self._source.read(_DECOMPRESS_INPUT_SIZE)
+            if not data:
+                break
+            self._buffer = self._decompressor.decompress(data)
+
+        result = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return result
+
+
+class NullCompressor(object):
+    def compress(self, data):
+        return data
+
+    def flush(self):
+        return ''
+
+
+class LZ4Compressor(object):
+    '''Adapts the lz4 frame compressor to the interface of
+    zlib.compressobj.'''
+    def __init__(self, level):
+        import lz4.frame
+        self._compressor = lz4.frame.LZ4FrameCompressor(
+            compression_level=level)
+        self._header = self._compressor.begin()
+
+    def compress(self, data):
+        result = self._header + self._compressor.compress(data)
+        self._header = ''
+        return result
+
+    def flush(self):
+        return self._header + self._compressor.flush()
+
+
+class Codec(object):
+    '''A way of compressing stored blocks.  Each block name ends with
+    the suffix of its codec, which for gzip is empty, so restore knows
+    how to decode it.'''
+    def __init__(self, name, suffix, default_level, compressor, reader):
+        self.name = name
+        self.suffix = suffix
+        self.default_level = default_level
+        self._compressor = compressor
+        self._reader = reader
+
+    def compress(self, source, level=None):
+        '''Return a file-like object yielding the compressed contents
+        of the file-like object source.'''
+        if level is None:
+            level = self.default_level
+        return CompressingReader(source, self._compressor(level))
+
+    def decompress(self, source):
+        '''Return a file-like object yielding the decompressed contents
+        of the file-like object source.'''
+        return self._reader(source)
+
+
+def _make_gzip_codec():
+    return Codec('gzip', '', 9,
+                 lambda level: zlib.compressobj(
+            level, zlib.DEFLATED, 16 + zlib.MAX_WBITS),
+                 DecompressingReader)
+
+def _make_none_codec():
+    return Codec('none', '.raw', 0,
+                 lambda level: NullCompressor(), lambda source: source)
+
+def _make_bz2_codec():
+    import bz2
+    return Codec('bz2', '.bz2', 9, bz2.BZ2Compressor,
+                 lambda source: ChunkedDecompressingReader(
+            source, bz2.BZ2Decompressor()))
+
+def _make_lzma_codec():
+    try:
+        import lzma
+    except ImportError:
+        from backports import lzma
+    return Codec('lzma', '.xz', 6,
+                 lambda level: lzma.LZMACompressor(preset=level),
+                 lambda source: ChunkedDecompressingReader(
+            source, lzma.LZMADecompressor()))
+
+def _make_zstd_codec():
+    import zstandard
+    return Codec('zstd', '.zst', 3,
+                 lambda level: zstandard.ZstdCompressor(
+            level=level).compressobj(),
+                 lambda source: zstandard.ZstdDecompressor().stream_reader(
+            source))
+
+def _make_lz4_codec():
+    import lz4.frame
+    return Codec('lz4', '.lz4', 0, LZ4Compressor,
+                 lambda source: lz4.frame.LZ4FrameFile(source, 'rb'))
+
+_CODEC_FACTORIES = collections.OrderedDict([
+        ('gzip', _make_gzip_codec),
+        ('none', _make_none_codec),
+        ('bz2', _make_bz2_codec),
+        ('lzma', _make_lzma_codec),
+        ('zstd', _make_zstd_codec),
+        ('lz4', _make_lz4_codec),
+        ])
+
+_CODEC_SUFFIXES = {
+    '': 'gzip', '.raw': 'none', '.bz2': 'bz2', '.xz': 'lzma',
+    '.zst': 'zstd', '.lz4': 'lz4'}
+
+# The codecs which auto mode prefers, fastest first.
+_AUTO_CODECS = ['zstd', 'lz4', 'gzip']
+
+_codecs = {}
+
+def get_codec(name):
+    '''Return the named Codec, raising ImportError if the module it
+    needs is not installed.'''
+    if name not in _codecs:
+        _codecs[name] = _CODEC_FACTORIES[name]()
+    return _codecs[name]
+
+_CODEC_SUFFIX_BY_NAME = dict((name, suffix) for suffix, name in
+                             _CODEC_SUFFIXES.iteritems())
+
+def get_block_codec_name(name):
+    '''Return the name of the codec used to store the named data
+    block.'''
+    return _CODEC_SUFFIXES[block_name_re.search(name).group(3) or '']
+
+def get_block_codec(name):
+    '''Return the Codec used to store the named data block.'''
+    return get_codec(get_block_codec_name(name))
+
+def parse_codec(text):
+    '''Parse a codec specification, [auto:]NAME[:LEVEL], or just auto,
+    returning the Codec, level and whether it is automatic.'''
+    fields = text.split(':')
+    auto = fields[0] == 'auto'
+    if auto:
+        fields = fields[1:]
+    if not fields:
+        for name in _AUTO_CODECS:
+            try:
+                get_codec(name)
+            except ImportError:
+                continue
+            fields = [name]
+            break
+
+    codec = get_codec(fields[0])
+    level = codec.default_level
+    if len(fields) > 1:
+        level = int(fields[1])
+    return codec, level, auto
+
+
+class S3ConnectionPool(object):
+    '''Handles on an S3 bucket, each with its own connection, lent to
+    one thread at a time.  Up to size are created as they are needed,
+    and they are kept between uses so that their HTTP connections stay
+    alive and are reused.'''
+
+    def __init__(self, connect, size):
+        self._connect = connect
+        self._idle = Queue.LifoQueue()
+        self._slots = threading.Semaphore(size)
+
+    def acquire(self):
+        self._slots.acquire()
+        try:
+            return self._idle.get_nowait()
+        except Queue.Empty:
+            pass
+        try:
+            return self._connect()
+        except:
+            self._slots.release()
+            raise
+
+    def release(self, bucket):
+        self._idle.put(bucket)
+        self._slots.release()
+
+    @contextlib.contextmanager
+    def bucket(self):
+        bucket = self.acquire()
+        try:
+            yield bucket
+        finally:
+            self.release(bucket)
+
+
+class S3Stream(object):
+    '''An S3 key being downloaded, which keeps its connection from the
+    pool until it is closed.'''
+    def __init__(self, key, release):
+        self._key = key
+        self._release = release
+
+    def read(self, size=-1):
+        # boto reads everything when asked for zero bytes.
+        return self._key.read(max(size, 0))
+
+    def close(self):
+        try:
+            self._key.close()
+        finally:
+            if self._release is not None:
+                self._release()
+                self._release = None
+
+
 class S3Storage(object):
-    '''A storage backend based on Amazon S3.'''
-    def __init__(self, args):
+    '''A storage backend based on Amazon S3, or any service compatible
+    with it at --endpoint.'''
+    def __init__(self, args, connections=None):
         import boto
         import boto.s3
         import boto.s3.connection
         import ConfigParser
+        import urlparse
 
         # Enable this if you need help debugging boto.
         #
@@ -118,38 +1406,174 @@ class S3Storage(object):
         assert args.bucket is not None
         assert args.prefix is not None
 
-        self._connection = boto.s3.connection.S3Connection(
-            args.access, args.secret)
-        self._bucket = self._connection.get_bucket(args.bucket)
+        options = {}
+        if args.endpoint is not None:
+            endpoint = urlparse.urlsplit(args.endpoint)
+            options = {
+                'host' : endpoint.hostname,
+                'port' : endpoint.port,
+                'is_secure' : endpoint.scheme != 'http',
+                'calling_format' :
+                    boto.s3.connection.OrdinaryCallingFormat(),
+                }
+
+        def connect():
+            connection = boto.s3.connection.S3Connection(
+                args.access, args.secret, **options)
+            # Validating the bucket costs a request, and any problem
+            # with it is reported by the first real one anyway.
+            return connection.get_bucket(args.bucket, validate=False)
+
+        if connections is None:
+            connections = {}
+        key = (args.endpoint, args.bucket, args.access)
+        if key not in connections:
+            connections[key] = S3ConnectionPool(connect, args.connections)
+        self._pool = connections[key]
+        self._part_jobs = args.part_jobs
+        self._delete_jobs = args.delete_jobs
         self.prefix = args.prefix
+        self.location = 's3://%s' % args.bucket
+        if args.endpoint is not None:
+            self.location = '%s/%s' % (args.endpoint.rstrip('/'), args.bucket)
 
     def exists(self, arg):
-        result = self._bucket.get_key(arg)
-        return result is not None and result.exists()
+        with self._pool.bucket() as bucket:
+            result = bucket.get_key(arg)
+            return result is not None and result.exists()
 
     def store(self, name, data, progress_function=None):
-        key = self._bucket.new_key(name)
-	try:
-            key.set_contents_from_string(data, cb=progress_function)
+        with self._pool.bucket() as bucket:
+            key = bucket.new_key(name)
+            try:
+                key.set_contents_from_string(data, cb=progress_function)
+            except:
+                sys.stderr.write(
+                    '\nError when writing name=%s len(data)=%d key=%s\n' % (
+                        name, len(data), repr(key)))
+                raise
+
+    def store_stream(self, name, stream, progress_function=None):
+        '''Store the contents of the file-like object stream.  Anything
+        larger than a single part is sent as a multipart upload, with
+        several parts in flight at once, each on its own connection.'''
+        import boto.s3.multipart
+
+        pending = [read_fully(stream, _PART_SIZE)]
+        if len(pending[0]) == _PART_SIZE:
+            pending.append(read_fully(stream, _PART_SIZE))
+        if len(pending[0]) < _PART_SIZE or not pending[-1]:
+            return self.store(name, ''.join(pending), progress_function)
+
+        with self._pool.bucket() as bucket:
+            upload_id = bucket.initiate_multipart_upload(name).id
+
+        def get_upload(bucket):
+            upload = boto.s3.multipart.MultiPartUpload(bucket)
+            upload.key_name = name
+            upload.id = upload_id
+            return upload
+
+        def read_parts():
+            part_num = 1
+            while True:
+                data = pending and pending.pop(0) or \
+                    read_fully(stream, _PART_SIZE)
+                if not data:
+                    break
+                yield part_num, data
+                part_num += 1
+
+        def upload_part(part):
+            part_num, data = part
+            with self._pool.bucket() as bucket:
+                get_upload(bucket).upload_part_from_file(
+                    cStringIO.StringIO(data), part_num, size=len(data))
+
+        try:
+            Pipeline([(upload_part, self._part_jobs)]).run(read_parts())
+            with self._pool.bucket() as bucket:
+                # Completing needs the list of parts, which a fresh
+                # handle on the upload must fetch.
+                get_upload(bucket).complete_upload()
         except:
             sys.stderr.write(
-                '\nError when writing name=%s len(data)=%d key=%s\n' % (
-                    name, len(data), repr(key)))
+                '\nError when writing name=%s in parts\n' % name)
+            with self._pool.bucket() as bucket:
+                get_upload(bucket).cancel_upload()
             raise
 
     def load(self, name, progress_function=None):
-        key = self._bucket.get_key(name)
-        return key.get_contents_as_string(cb=progress_function)
+        with self._pool.bucket() as bucket:
+            key = bucket.get_key(name)
+            return key.get_contents_as_string(cb=progress_function)
+
+    def load_stream(self, name):
+        '''Return a file-like object, which must be closed, that reads
+        the named object as it is downloaded.'''
+        bucket = self._pool.acquire()
+        try:
+            key = bucket.get_key(name)
+            key.open_read()
+        except:
+            self._pool.release(bucket)
+            raise
+        return S3Stream(key, lambda: self._pool.release(bucket))
 
     def list(self, prefix):
-        return [x.name for x in self._bucket.list(prefix)]
+        with self._pool.bucket() as bucket:
+            return [x.name for x in bucket.list(prefix)]
+
+    def list_sizes(self, prefix):
+        '''Return a dictionary mapping each name with the given prefix
+        to its size.'''
+        with self._pool.bucket() as bucket:
+            return dict((x.name, x.size) for x in bucket.list(prefix))
 
     def remove(self, name):
-        self._bucket.delete_key(name)
+        with self._pool.bucket() as bucket:
+            bucket.delete_key(name)
+
+    def sync(self):
+        '''S3 objects are durable once stored, so there is nothing to
+        do.'''
+        pass
+
+    def remove_many(self, names):
+        '''Remove all the named objects, and return a dictionary
+        mapping the name of each that could not be removed to the
+        reason.'''
+        def remove_batch(batch):
+            with self._pool.bucket() as bucket:
+                return bucket.delete_keys(batch, quiet=True)
+
+        names = list(names)
+        batches = [names[i:i + _DELETE_BATCH_SIZE]
+                   for i in range(0, len(names), _DELETE_BATCH_SIZE)]
+        errors = {}
+        for result in map_ahead(remove_batch, batches, self._delete_jobs):
+            for error in result.errors:
+                errors[error.key] = '%s: %s' % (error.code, error.message)
+        return errors
         
 
+def list_directory(directory):
+    '''Return the names in a directory, using scandir where it is
+    available since it is faster on large directories.'''
+    if scandir is None:
+        return os.listdir(directory)
+    return [entry.name for entry in scandir(directory)]
+
+
 class DirectoryStorage(object):
-    '''A storage backend that just maps to the local filesystem.'''
+    '''A storage backend that just maps to the local filesystem.
+
+    With the sharded layout, data blocks are written to subdirectories
+    of _SHARD_DIRECTORY named by the start of their hash, so that no
+    one directory grows too large.  Everything else is kept in the top
+    directory, as is everything in the flat layout, and both places
+    are always read.  Objects are written to a temporary file and
+    renamed into place, and are synced in batches, or by sync().'''
     def __init__(self, args):
         self.directory, self.prefix = os.path.split(args.directory)
         
@@ -157,31 +1581,153 @@ class DirectoryStorage(object):
             self.directory = self.prefix
         if self.prefix == '':
             self.prefix = self.directory
+        self.location = os.path.abspath(self.directory)
+        self._delete_jobs = args.delete_jobs
+        self._sharded = args.directory_layout == 'sharded'
+        self._lock = threading.Lock()
+        self._unsynced = []
+
+    def _paths(self, name):
+        '''Return the paths where the named object may be found, with
+        the one it would be written to first.'''
+        paths = [os.path.join(self.directory, name)]
+        match = block_name_re.search(name)
+        if match is not None:
+            shard_path = os.path.join(
+                self.directory, _SHARD_DIRECTORY,
+                match.group(2)[:_SHARD_DIGITS], name)
+            if self._sharded:
+                paths.insert(0, shard_path)
+            else:
+                paths.append(shard_path)
+        return paths
+
+    def _path(self, name):
+        paths = self._paths(name)
+        for path in paths:
+            if os.path.exists(path):
+                return path
+        return paths[0]
 
     def exists(self, arg):
-        return os.path.exists(os.path.join(self.directory, arg))
+        return any(os.path.exists(path) for path in self._paths(arg))
+
+    def _write(self, name, write):
+        path = self._paths(name)[0]
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        temp_path = os.path.join(directory, '.%s.%d.tmp' % (
+                name, threading.current_thread().ident))
+        try:
+            f = open(temp_path, 'wb')
+            try:
+                write(f)
+            finally:
+                f.close()
+            os.rename(temp_path, path)
+        except:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        with self._lock:
+            self._unsynced.append(path)
+            if len(self._unsynced) < _SYNC_BATCH_SIZE:
+                return
+        self.sync()
+
+    def sync(self):
+        '''Make sure everything stored so far is on disk.'''
+        with self._lock:
+            paths, self._unsynced = self._unsynced, []
+        for path in paths + sorted(set(os.path.dirname(x) for x in paths)):
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError, e:
+                # It has been removed since.
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
 
     def store(self, name, data, progress_function=None):
-        f = open(os.path.join(self.directory, name), 'wb')
-        f.write(data)
-        f.close()
+        self._write(name, lambda f: f.write(data))
+
+    def store_stream(self, name, stream, progress_function=None):
+        def write(f):
+            while True:
+                data = stream.read(_CHUNK_SIZE)
+                if not data:
+                    break
+                f.write(data)
+        self._write(name, write)
 
     def load(self, name, progress_function=None):
-        f = open(os.path.join(self.directory, name), 'rb')
+        f = open(self._path(name), 'rb')
         result = f.read()
         f.close()
         return result
 
+    def load_stream(self, name):
+        return open(self._path(name), 'rb')
+
+    def _list(self, prefix):
+        '''Return a dictionary mapping the name of each object starting
+        with prefix to its path.  Only data blocks are sharded, and
+        they are only listed by prefixes including "-data-".'''
+        directories = [self.directory]
+        shards = os.path.join(self.directory, _SHARD_DIRECTORY)
+        if '-data-' in prefix and os.path.isdir(shards):
+            directories.extend(os.path.join(shards, x)
+                               for x in sorted(list_directory(shards)))
+        result = {}
+        for directory in directories:
+            for name in list_directory(directory):
+                if name.startswith(prefix):
+                    result[name] = os.path.join(directory, name)
+        return result
+
     def list(self, prefix):
-        return [os.path.basename(x) for x in
-                glob.glob(os.path.join(self.directory, prefix) + '*') ]
+        return sorted(self._list(prefix))
+
+    def list_sizes(self, prefix):
+        return dict((name, os.path.getsize(path))
+                    for name, path in self._list(prefix).iteritems())
 
     def remove(self, name):
-        os.remove(os.path.join(self.directory, name))
+        paths = [x for x in self._paths(name) if os.path.exists(x)]
+        if not paths:
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), name)
+        for path in paths:
+            os.remove(path)
+
+    def remove_many(self, names):
+        def remove(name):
+            try:
+                self.remove(name)
+            except OSError, e:
+                # As with S3, removing what is already gone succeeds.
+                if e.errno != errno.ENOENT:
+                    return name, str(e)
+            return None
+
+        names = list(names)
+        return dict(x for x in map_ahead(remove, names, self._delete_jobs)
+                    if x is not None)
         
 
-def make_storage(args):
-    '''Create the storage backend appropriate for the given arguments.'''
+def make_storage(args, connections=None):
+    '''Create the storage backend appropriate for the given arguments.
+    S3 connection pools are shared through the dictionary connections,
+    if given, by every storage using the same bucket.'''
 
     if args.directory is not None:
         assert args.access is None
@@ -190,32 +1736,515 @@ def make_storage(args):
         assert args.prefix is None
         return DirectoryStorage(args)
     
-    return S3Storage(args)
+    return S3Storage(args, connections)
+
+def get_state_path(storage, args, prefix, suffix):
+    '''Return the path of a local state file for the given prefix
+    within this storage.'''
+    state_dir = os.path.expanduser(args.state_dir)
+    if not os.path.exists(state_dir):
+        os.makedirs(state_dir)
+    key = hashlib.sha1(storage.location + '\0' + prefix).hexdigest()[:16]
+    return os.path.join(state_dir, '%s-%s%s' % (
+            os.path.basename(prefix), key, suffix))
+
+
+class BlockIndex(object):
+    '''A local record of the data blocks known to exist in a storage
+    backend, and their stored sizes, so that a backup need not ask the
+    backend about each block.  It is kept as an append only file of
+    the names under one data prefix, seeded from a single listing of
+    the backend.'''
+
+    def __init__(self, storage, prefix, path, reindex=False):
+        self._storage = storage
+        self._prefix = prefix
+        self._path = path
+        self._lock = threading.Lock()
+        self._file = None
+
+        if reindex or not os.path.exists(path):
+            self.rebuild()
+        else:
+            self._sizes = {}
+            f = open(path, 'r')
+            for line in f:
+                fields = line.split()
+                if fields:
+                    # Older indices did not record sizes.
+                    self._sizes[fields[0]] = (
+                        len(fields) > 1 and int(fields[1]) or None)
+            f.close()
+            self._file = open(path, 'a')
+
+    def rebuild(self):
+        self._write(self._storage.list_sizes(self._prefix + '-data-'))
+
+    def _format(self, name, size):
+        if size is None:
+            return name + '\n'
+        return '%s %d\n' % (name, size)
+
+    def _write(self, sizes):
+        if self._file is not None:
+            self._file.close()
+        temp_path = self._path + '.tmp'
+        f = open(temp_path, 'w')
+        f.write(''.join(self._format(name, sizes[name])
+                        for name in sorted(sizes)))
+        f.close()
+        os.rename(temp_path, self._path)
+        self._sizes = dict(sizes)
+        self._file = open(self._path, 'a')
+
+    def __contains__(self, name):
+        return name in self._sizes
+
+    def size(self, name):
+        '''Return the stored size of the named block, or None if it is
+        not known.'''
+        return self._sizes.get(name)
+
+    def add(self, name, size=None):
+        with self._lock:
+            if name in self._sizes:
+                return
+            self._sizes[name] = size
+            self._file.write(self._format(name, size))
+            self._file.flush()
+
+    def discard(self, names):
+        with self._lock:
+            self._write(dict((name, size)
+                             for name, size in self._sizes.iteritems()
+                             if name not in names))
+
+    def close(self):
+        self._file.close()
+
+
+def open_block_index(storage, args, prefix, reindex=False):
+    return BlockIndex(storage, prefix,
+                      get_state_path(storage, args, prefix, '.index'),
+                      reindex=reindex)
+
+
+class ManifestCache(object):
+    '''A local copy of each manifest read from or written to storage.
+    Manifests never change once written, so copies need never be
+    invalidated, only discarded when the manifest is removed.'''
+
+    def __init__(self, storage, directory):
+        self._storage = storage
+        self._directory = directory
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def _path(self, name):
+        return os.path.join(self._directory, name)
+
+    def __contains__(self, name):
+        return os.path.exists(self._path(name))
+
+    def load(self, name):
+        '''Return the parsed Manifest of the given name.'''
+        if name in self:
+            f = open(self._path(name), 'r')
+            data = f.read()
+            f.close()
+        else:
+            data = self._storage.load(name)
+            self.store(name, data)
+        return parse_manifest(data)
+
+    def store(self, name, data):
+        temp_path = '%s.%d.tmp' % (self._path(name),
+                                   threading.current_thread().ident)
+        f = open(temp_path, 'w')
+        f.write(data)
+        f.close()
+        os.rename(temp_path, self._path(name))
+
+    def discard(self, name):
+        if name in self:
+            os.remove(self._path(name))
+
+def open_manifest_cache(storage, args, prefix=None):
+    return ManifestCache(storage, get_state_path(
+            storage, args, prefix or storage.prefix, '.manifests'))
+
+
+class RefCounts(object):
+    '''A local count of the references to each data block from a set
+    of manifests, so that cleanup need not read every manifest to
+    find the blocks still in use.  It is reconciled against a listing
+    of the manifests with sync() before use.'''
+
+    def __init__(self, path):
+        self._path = path
+        self.manifests = set()
+        self.counts = {}
+        if os.path.exists(path):
+            f = open(path, 'r')
+            state = json.load(f)
+            f.close()
+            self.manifests = set(state['manifests'])
+            self.counts = state['counts']
+
+    def add(self, manifest_name, manifest):
+        if manifest_name in self.manifests:
+            return
+        self.manifests.add(manifest_name)
+        for item in manifest.items:
+            if item.name != _ZERO_BLOCK_NAME:
+                self.counts[item.name] = self.counts.get(item.name, 0) + 1
+
+    def remove(self, manifest_name, manifest):
+        if manifest_name not in self.manifests:
+            return
+        self.manifests.discard(manifest_name)
+        for item in manifest.items:
+            if item.name == _ZERO_BLOCK_NAME:
+                continue
+            self.counts[item.name] -= 1
+            if self.counts[item.name] == 0:
+                del self.counts[item.name]
+
+    def sync(self, manifest_names, cache, jobs):
+        '''Count exactly the given manifests, loading those not yet
+        counted through cache, jobs at a time.'''
+        manifest_names = set(manifest_names)
+        removed = self.manifests - manifest_names
+        if any(name not in cache for name in removed):
+            # A manifest has gone which can no longer be read, so its
+            # references can only be dropped by counting afresh.
+            self.manifests = set()
+            self.counts = {}
+            removed = set()
+        for name in removed:
+            self.remove(name, cache.load(name))
+            cache.discard(name)
+
+        added = sorted(manifest_names - self.manifests)
+        for name, manifest in zip(added, map_ahead(cache.load, added, jobs)):
+            self.add(name, manifest)
+
+    def referenced(self):
+        '''Return the set of block names referenced by any manifest.'''
+        return set(self.counts)
+
+    def save(self):
+        temp_path = self._path + '.tmp'
+        f = open(temp_path, 'w')
+        json.dump({'manifests': sorted(self.manifests),
+                   'counts': self.counts}, f)
+        f.close()
+        os.rename(temp_path, self._path)
+
+def open_ref_counts(storage, args, prefix=None):
+    return RefCounts(get_state_path(
+            storage, args, prefix or storage.prefix, '.refs'))
+
+
+def compress_block(data, codec_name='gzip'):
+    return get_codec(codec_name).compress(cStringIO.StringIO(data)).read()
+
+def decompress_block(compressed, codec_name='gzip'):
+    reader = get_codec(codec_name).decompress(cStringIO.StringIO(compressed))
+    return ''.join(iter(lambda: reader.read(_CHUNK_SIZE), ''))
+
+def is_worth_compressing(samples, codec, level):
+    '''Whether compressing the sampled data with codec saves enough to
+    be worth the CPU time.'''
+    data = ''.join(samples)
+    if not data:
+        return False
+    compressed = codec.compress(cStringIO.StringIO(data), level).read()
+    return len(compressed) < _AUTO_MAX_RATIO * len(data)
+
+def hash_stream(stream, hash_function=None):
+    '''Return the hex digest and length of everything in stream.'''
+    reader = HashingReader(stream, hash_function)
+    while reader.read(_CHUNK_SIZE):
+        pass
+    return reader.hexdigest(), reader.size
+
+# The value each byte contributes to the content defined chunking
+# rolling sum.  This must never change, or chunks will no longer line
+# up with those in earlier backups.
+_CDC_TABLE = [int(hashlib.md5(chr(i)).hexdigest()[:8], 16)
+              for i in range(256)]
+
+def parse_size(text):
+    '''Parse a size such as 4096, 512K or 4M.'''
+    multipliers = {'K': 2**10, 'M': 2**20, 'G': 2**30}
+    text = text.strip().upper()
+    if text[-1:] in multipliers:
+        return int(text[:-1]) * multipliers[text[-1]]
+    return int(text)
+
+class Chunker(object):
+    '''Splits a file into content defined chunks, so that data
+    inserted or removed only changes the chunks around it.
+
+    A chunk may end at any offset where the sum of _CDC_TABLE over the
+    preceding _CDC_WINDOW bytes, modulo 2**32, is below a threshold
+    chosen to give the requested average size.  These candidates are
+    found a whole scan buffer at a time, using numpy if it is
+    available.'''
+
+    def __init__(self, min_size, avg_size, max_size):
+        assert 0 < min_size <= avg_size <= max_size
+        self._min_size = min_size
+        self._max_size = max_size
+        self._threshold = 2**32 / max(1, avg_size - min_size)
+
+        try:
+            import numpy
+            self._numpy = numpy
+            self._table = numpy.array(_CDC_TABLE, dtype=numpy.uint32)
+        except ImportError:
+            self._numpy = None
+            print >>sys.stderr, ('warning: numpy is not installed, so ' +
+                                 'content defined chunking will be slow')
+
+    def candidates(self, data, base):
+        '''Return every offset in data, plus base, where a chunk may
+        end.'''
+        window = _CDC_WINDOW
+        if len(data) < window:
+            return []
+
+        numpy = self._numpy
+        if numpy is not None:
+            sums = numpy.take(self._table,
+                              numpy.frombuffer(data, dtype=numpy.uint8))
+            numpy.cumsum(sums, out=sums)
+            # sums[i] now covers data[:i + 1], so the window ending at
+            # offset p sums to sums[p - 1] - sums[p - 1 - window].
+            result = (numpy.flatnonzero(
+                    sums[window:] - sums[:-window] < self._threshold) +
+                      (base + window + 1)).tolist()
+            if sums[window - 1] < self._threshold:
+                result.insert(0, base + window)
+            return result
+
+        table = _CDC_TABLE
+        threshold = self._threshold
+        data = bytearray(data)
+        result = []
+        total = 0
+        for i in xrange(len(data)):
+            total += table[data[i]]
+            if i >= window:
+                total -= table[data[i - window]]
+            if i >= window - 1 and (total & 0xffffffff) < threshold:
+                result.append(base + i + 1)
+        return result
+
+    def chunks(self, source, size, workers=1, stats=None):
+        '''Yield the offset and length of each chunk of the first size
+        bytes of the PositionalFile source, with a list of read-only
+        views of its data.  Candidates are found by scanning ahead on
+        several threads, and the data scanned is what the views show,
+        so the device is only read once.'''
+        def scan(start):
+            # Windows may straddle two scans.
+            context = min(start, _CDC_WINDOW - 1)
+            # Each scan has a buffer of its own, as views of it live on
+            # until the chunks they belong to are stored.
+            buf = AlignedBuffer(_CDC_SCAN_SIZE + _CDC_WINDOW)
+            read_start = time.time()
+            data = source.read_into(
+                start - context, min(_CDC_SCAN_SIZE, size - start) + context,
+                buf)
+            scan_start = time.time()
+            result = self.candidates(data, start - context)
+            if stats is not None:
+                stats.add('read', scan_start - read_start, len(data))
+                stats.add('chunk', time.time() - scan_start, len(data))
+            return start, buffer(data, context), result
+
+        scans = map_ahead(scan, xrange(0, size, _CDC_SCAN_SIZE), workers)
+        candidates = []
+        # The start and data of each scan not yet wholly chunked.
+        scanned_data = collections.deque()
+        scanned = 0
+        offset = 0
+        try:
+            while offset < size:
+                # Find every candidate up to the largest chunk we could
+                # produce.
+                limit = min(size, offset + self._max_size)
+                while scanned < limit:
+                    start, data, found = next(scans)
+                    scanned_data.append((start, data))
+                    candidates.extend(found)
+                    scanned = min(size, scanned + _CDC_SCAN_SIZE)
+
+                index = bisect.bisect_left(candidates,
+                                           offset + self._min_size)
+                if index < len(candidates) and candidates[index] < limit:
+                    end = candidates[index]
+                else:
+                    end = limit
+                del candidates[:bisect.bisect_right(candidates, end)]
+
+                pieces = []
+                for start, data in scanned_data:
+                    if start >= end:
+                        break
+                    first = max(offset, start)
+                    last = min(end, start + len(data))
+                    if first < last:
+                        pieces.append(buffer(data, first - start,
+                                             last - first))
+                while scanned_data and \
+                        scanned_data[0][0] + len(scanned_data[0][1]) <= end:
+                    scanned_data.popleft()
+
+                yield offset, end - offset, pieces
+                offset = end
+        finally:
+            scans.close()
+
 
 def get_canonical_block_name(storage, block_num, name):
     prefix = storage.prefix
     return '%s-data-%08x-%s' % (prefix, block_num, name)
 
+def get_pool(storage, args):
+    '''Return the prefix under which content addressed blocks are
+    stored.  Devices sharing a pool share their blocks.'''
+    return args.pool or storage.prefix
+
+def get_content_block_name(pool, name):
+    return '%s-data-%s' % (pool, name)
+
+def get_block_name(storage, args, block_num, name, codec):
+    if args.layout == 'content':
+        result = get_content_block_name(get_pool(storage, args), name)
+    else:
+        result = get_canonical_block_name(storage, block_num, name)
+    return result + codec.suffix
+
+def get_pool_member_name(pool, prefix):
+    '''Return the name of the marker recording that prefix stores its
+    blocks in pool, so that cleaning up the pool considers its
+    manifests too.'''
+    return '%s-pool-%s' % (pool, prefix)
+
+block_name_re = re.compile(
+    '-data-(?:([0-9a-f]{8})-)?([0-9a-f]+)(\.[a-z0-9]+)?$')
+
+def parse_block_name(name):
+    '''Return the block number and hash of a data block.  The block
+    number is None for content addressed blocks.'''
+    m = block_name_re.search(name)
+    block_num = m.group(1)
+    if block_num is not None:
+        block_num = int(block_num, 16)
+    return block_num, m.group(2)
+
+def block_name_matches(name, block_num, digest):
+    '''Whether the named data block holds data with the given hash, at
+    the given block number.'''
+    name_block_num, name_digest = parse_block_name(name)
+    return (name_digest == digest and
+            name_block_num in (None, block_num))
+
 def create_manifest_name(storage):
     prefix = storage.prefix
     return '%s-manifest-%s-%08x' % (
         prefix, datetime.datetime.utcnow().strftime('%Y%m%d-%H%M%S'),
         random.getrandbits(32))
 
-def create_manifest(args, manifest_items):
+def create_manifest(args, manifest_items, data_prefix, size, hash_function):
+    '''Create a manifest for the device backed up into the given
+    ManifestItems, whose blocks are stored under data_prefix.
+
+    Each block is described by a fixed width record, so that any one
+    can be found by its index alone.  The record fields are the
+    offset, length, stored size (compressed, all dashes if unknown), 1
+    if this backup stored the block or 0 if it already existed, codec
+    (or "zero" for a zero block) and hash (dashes for a zero
+    block).'''
+    if args.manifest_version == '1':
+        return create_v1_manifest(args, manifest_items, hash_function)
+
+    digest_size = hash_function.digest_size * 2
+    records = []
+    for item in manifest_items:
+        assert item.length < 2**32
+        if item.name == _ZERO_BLOCK_NAME:
+            codec_name = _ZERO_BLOCK_NAME
+            digest = '-' * digest_size
+        else:
+            codec_name = get_block_codec_name(item.name)
+            block_num, digest = parse_block_name(item.name)
+        if item.stored_size is None:
+            stored_size = '-' * 8
+        else:
+            stored_size = '%08x' % item.stored_size
+        records.append('%016x %08x %s %d %-4s %s\n' % (
+                item.offset, item.length, stored_size, int(item.new),
+                codec_name, digest))
+
     header = \
 '''Version: %s
 Created-by: s3bdbk %s
 Block-size: %d
 Source: %s
 Date: %s
-Hash: %s
+%sLayout: %s
+Data-prefix: %s
+Size: %d
+Records: %d
+Record-size: %d
 
 ''' % (_BACKUP_VERSION, _S3BDBK_VERSION, _BLOCK_SIZE, args.block,
        datetime.datetime.utcnow().isoformat(),
-       _HASH_FUNCTION().name)
+       hash_function.header(), args.layout, data_prefix, size,
+       len(records), 43 + digest_size)
+
+    return header + ''.join(records)
+
+def create_v1_manifest(args, manifest_items, hash_function):
+    version = _V1_BACKUP_VERSION
+    extra_headers = ''
+    if args.layout == 'content':
+        extra_headers = 'Layout: content\n'
+    elif hash_function.name == _DEFAULT_HASH and \
+            hash_function.leaf_size is None and \
+            all(item.name != _ZERO_BLOCK_NAME and
+                get_block_codec_name(item.name) == 'gzip' and
+                item.length == _BLOCK_SIZE
+                for item in manifest_items):
+        version = _POSITIONAL_BACKUP_VERSION
+
+    header = \
+'''Version: %s
+Created-by: s3bdbk %s
+Block-size: %d
+Source: %s
+Date: %s
+%s%s
+''' % (version, _S3BDBK_VERSION, _BLOCK_SIZE, args.block,
+       datetime.datetime.utcnow().isoformat(),
+       hash_function.header(), extra_headers)
     
-    return header + ''.join([item + '\n' for item in manifest_items])
+    # Version 1.0 manifests stay readable by older versions, so they
+    # are only written when every block is full sized; newer ones
+    # record the length of short or variable sized blocks.
+    lines = []
+    for item in manifest_items:
+        if version != _POSITIONAL_BACKUP_VERSION and \
+                item.length != _BLOCK_SIZE:
+            lines.append('%s %d\n' % (item.name, item.length))
+        else:
+            lines.append(item.name + '\n')
+
+    return header + ''.join(lines)
 
 def parse_header(header):
     lines = header.strip().split('\n')
@@ -224,74 +2253,456 @@ def parse_header(header):
                    for line in lines])
     return result
 
+class ManifestItem(object):
+    '''One region of a backed up device, and the data block holding
+    it.  Version 1 manifests do not record the stored size or whether
+    the backup stored the block.'''
+    def __init__(self, block_num, offset, length, name,
+                 stored_size=None, new=False):
+        self.block_num = block_num
+        self.offset = offset
+        self.length = length
+        self.name = name
+        self.stored_size = stored_size
+        self.new = new
+
+class Manifest(object):
+    '''A parsed manifest.  The device size is None for version 1
+    manifests, which do not record it.'''
+    def __init__(self, headers, items):
+        self.headers = headers
+        self.version = headers['Version']
+        self.block_size = int(headers['Block-size'])
+        self.size = None
+        if 'Size' in headers:
+            self.size = int(headers['Size'])
+        self.items = items
+
 def parse_manifest(data):
-    header, content = data.split('\n\n')
+    header, content = data.split('\n\n', 1)
     key_values = parse_header(header)
 
-    assert key_values['Version'] == _BACKUP_VERSION
+    if key_values['Version'] == _BACKUP_VERSION:
+        return Manifest(key_values, parse_records(key_values, content))
+
+    assert key_values['Version'] in (_POSITIONAL_BACKUP_VERSION,
+                                     _V1_BACKUP_VERSION)
     block_size = int(key_values['Block-size'])
+
+    items = []
+    offset = 0
+    for line in content.strip().split('\n'):
+        fields = line.split()
+        length = block_size
+        if len(fields) > 1:
+            length = int(fields[1])
+        items.append(ManifestItem(len(items), offset, length, fields[0]))
+        offset += length
     
-    return content.strip().split('\n'), block_size
+    return Manifest(key_values, items)
+
+def parse_records(key_values, content):
+    '''Parse the fixed width block records of a version 2 manifest.'''
+    record_size = int(key_values['Record-size'])
+    num_records = int(key_values['Records'])
+    assert len(content) == record_size * num_records
+
+    content_layout = key_values['Layout'] == 'content'
+    data_prefix = key_values['Data-prefix']
+
+    items = []
+    for block_num in range(num_records):
+        record = content[block_num * record_size:
+                         (block_num + 1) * record_size]
+        offset, length, stored_size, new, codec_name, digest = record.split()
+        if stored_size.startswith('-'):
+            stored_size = None
+        else:
+            stored_size = int(stored_size, 16)
+
+        if codec_name == _ZERO_BLOCK_NAME:
+            name = _ZERO_BLOCK_NAME
+        elif content_layout:
+            name = get_content_block_name(data_prefix, digest)
+        else:
+            name = '%s-data-%08x-%s' % (data_prefix, block_num, digest)
+        if name != _ZERO_BLOCK_NAME:
+            name += _CODEC_SUFFIX_BY_NAME[codec_name]
+
+        items.append(ManifestItem(block_num, int(offset, 16), int(length, 16),
+                                  name, stored_size, new == '1'))
+    return items
 
 def get_current_name(storage):
     prefix = storage.prefix
     return '%s-current' % prefix
 
 
-def do_backup(args):
-    start_time = time.time()
-    
-    storage = make_storage(args)
-    block = open(args.block, 'rb')
-    progress = Progress(args, 'backup')
+class BackupError(Exception):
+    pass
 
-    block.seek(0, os.SEEK_END)
-    size = block.tell()
-    block.seek(0)
+class BackupJournal(object):
+    '''A local record of the blocks a backup has stored or found to
+    exist so far, so that an interrupted backup can be resumed.  It
+    begins with a header describing the backup, followed by one line
+    for each block completed, in the order they complete.'''
 
-    num_blocks = (size + _BLOCK_SIZE - 1) / _BLOCK_SIZE
+    def __init__(self, path, header, resume=False):
+        self._path = path
+        self._header = header
+        self._lock = threading.Lock()
+        self.blocks = {}
 
-    # Iterate through the chunks in this block device and store each
-    # one, building up our manifest as we go.
+        if resume and os.path.exists(path):
+            self._load()
+        self._write()
 
-    block_num = 0
-    manifest_items = []
-    while True:
-        progress.update(block_num * _BLOCK_SIZE, size, 'preparing block')
-        
-        data = block.read(_BLOCK_SIZE)
-        if len(data) == 0:
-            # all done
-            break
-        hasher = _HASH_FUNCTION()
-        hasher.update(data)
-        name = hasher.hexdigest()
-        storage_name = get_canonical_block_name(storage, block_num, name)
+    def _format_header(self):
+        return ''.join('%s: %s\n' % (key, self._header[key])
+                       for key in sorted(self._header)) + '\n'
 
-        if not storage.exists(storage_name):
-            dest = cStringIO.StringIO()
-            f = gzip.GzipFile(mode='wb', fileobj=dest)
-            f.write(data)
-            f.close()
+    def _load(self):
+        f = open(self._path, 'r')
+        data = f.read()
+        f.close()
+        if not data.startswith(self._format_header()):
+            # It was left by a backup of something else.
+            return
+        for line in data[len(self._format_header()):].split('\n'):
+            fields = line.split()
+            # The last line may have been cut short.
+            if len(fields) != 6:
+                continue
+            block_num, offset, length, stored_size, new, name = fields
+            item = BackupBlock(int(block_num), int(offset), int(length))
+            item.storage_name = name
+            if stored_size != '-':
+                item.stored_size = int(stored_size)
+            item.new = new == '1'
+            self.blocks[item.block_num] = item
+
+    def _format(self, item):
+        stored_size = '-'
+        if item.stored_size is not None:
+            stored_size = str(item.stored_size)
+        return '%d %d %d %s %d %s\n' % (
+            item.block_num, item.offset, item.length, stored_size,
+            int(item.new), item.storage_name)
+
+    def _write(self):
+        temp_path = self._path + '.tmp'
+        f = open(temp_path, 'w')
+        f.write(self._format_header())
+        f.write(''.join(self._format(self.blocks[x])
+                        for x in sorted(self.blocks)))
+        f.close()
+        os.rename(temp_path, self._path)
+        self._file = open(self._path, 'a')
+
+    def is_complete(self, item):
+        '''Whether the given block was completed by the backup being
+        resumed.'''
+        done = self.blocks.get(item.block_num)
+        return (done is not None and done.offset == item.offset and
+                done.length == item.length)
+
+    def record(self, item):
+        with self._lock:
+            self.blocks[item.block_num] = item
+            self._file.write(self._format(item))
+            self._file.flush()
+
+    def discard(self, names):
+        '''Forget the blocks stored under any of the given names, so
+        that resuming reads and stores them again.'''
+        with self._lock:
+            for block_num, item in self.blocks.items():
+                if item.storage_name in names:
+                    del self.blocks[block_num]
+            self._file.close()
+            self._write()
+
+    def close(self):
+        self._file.close()
+
+    def remove(self):
+        self.close()
+        os.remove(self._path)
+
+
+class BackupBlock(object):
+    '''One block of the source device as it moves through the backup
+    pipeline.'''
+    def __init__(self, block_num, offset, length):
+        self.block_num = block_num
+        self.offset = offset
+        self.length = length
+        self.codec = None
+        self.storage_name = None
+        self.stored_size = None
+        self.new = False
+        # With content defined chunking, views of the data read while
+        # finding the chunk, so it need not be read again.
+        self.data = None
+
+
+def do_backup(args, storage=None, pipeline=None):
+    '''Back up the -b device, to storage if it is given, or otherwise
+    to that chosen by args.  Blocks are read, compressed and stored
+    by the workers of the SharedPipeline pipeline if it is given, or
+    otherwise by workers of our own.'''
+    start_time = time.time()
+    
+    if args.chunking == 'cdc':
+        # Chunks move whenever data is inserted before them, so they
+        # can only be named by their content.
+        args.layout = 'content'
+
+    codec, level, auto_codec = parse_codec(args.codec)
+    if storage is None:
+        storage = make_storage(args)
+    block = PositionalFile(args.block, direct=args.direct_io)
+    progress = Progress(args, 'backup')
+    stats = open_stats(args, 'backup')
+    hash_function = get_hash_function(args)
+    pool = get_pool(storage, args)
+    index = open_block_index(storage, args, pool, reindex=args.reindex)
 
-            def update_progress(count, total):
-                scaled = _BLOCK_SIZE * float(count) / float(total)
-                progress.update(block_num * _BLOCK_SIZE + scaled, size,
-                                'storing block')
-                
-            storage.store(storage_name, dest.getvalue(), update_progress)
+    if pool != storage.prefix:
+        storage.store(get_pool_member_name(pool, storage.prefix), '')
 
-        manifest_items.append(storage_name)
-            
-        block_num += 1
+    size = block.size()
 
-        if len(data) < _BLOCK_SIZE:
-            break
+    num_blocks = (size + _BLOCK_SIZE - 1) / _BLOCK_SIZE
+
+    # Each block is hashed by one pool of workers, and those not
+    # already present are compressed and uploaded by a second pool.
+    # Blocks are streamed from the device in pieces rather than held
+    # in memory, so a stored block is read twice.  Content defined
+    # chunks are the exception: the data read to find them is kept
+    # until they are stored.  Blocks may complete
+    # out of order, so the manifest is assembled by block number at
+    # the end.
+
+    # Each completed block is journaled, so that an interrupted backup
+    # can be resumed without reading those blocks again.
+    chunking = args.chunking
+    if chunking == 'cdc':
+        chunking += ' ' + args.chunk_sizes
+    journal = BackupJournal(
+        get_state_path(storage, args, storage.prefix, '.journal'),
+        {'Device' : os.path.abspath(args.block),
+         'Size' : size,
+         'Block-size' : _BLOCK_SIZE,
+         'Hash' : hash_function.header().replace('\n', ' ').strip(),
+         'Layout' : args.layout,
+         'Chunking' : chunking,
+         'Data-prefix' : pool},
+        resume=args.resume)
+
+    backup_blocks = dict(journal.blocks)
+    completed = [sum(x.length for x in backup_blocks.itervalues())]
+    lock = threading.Lock()
+
+    # The names being stored right now, so that identical blocks are
+    # only stored once.
+    storing = set()
+
+    def read_blocks():
+        for item in read_device_blocks():
+            if not journal.is_complete(item):
+                yield item
+
+    def read_device_blocks():
+        if args.chunking == 'cdc':
+            chunker = Chunker(*[parse_size(x)
+                                for x in args.chunk_sizes.split(':')])
+            for block_num, (offset, length, data) in enumerate(
+                chunker.chunks(block, size, args.jobs, stats)):
+                item = BackupBlock(block_num, offset, length)
+                item.data = data
+                yield item
+            return
+
+        for block_num in range(num_blocks):
+            offset = block_num * _BLOCK_SIZE
+            yield BackupBlock(block_num, offset,
+                              min(_BLOCK_SIZE, size - offset))
+
+    zeros = '\0' * _CHUNK_SIZE
+
+    def read_block(item):
+        '''Return a reader of the block's data, and whether that reads
+        the device rather than data already read.'''
+        if item.data is not None:
+            return PiecesReader(item.data), False
+        return RegionReader(block, item.offset, item.length), True
+
+    def prepare_block(item):
+        if block.is_hole(item.offset, item.length):
+            item.data = None
+            item.storage_name = _ZERO_BLOCK_NAME
+            return item
+
+        # Each stage is timed as the time spent in its reads less that
+        # spent in the reads of the stage it reads from.
+        source, from_device = read_block(item)
+        region = TimedReader(source)
+        hashing = HashingReader(region, hash_function)
+        reader = TimedReader(hashing)
+        samples = []
+        is_zero = True
+        while True:
+            data = reader.read(_CHUNK_SIZE)
+            if not data:
+                break
+            if is_zero and not zeros.startswith(data):
+                is_zero = False
+            if auto_codec:
+                samples.append(data[:_AUTO_SAMPLE_SIZE])
+        if from_device:
+            stats.add('read', region.elapsed, region.size)
+        stats.add('hash', reader.elapsed - region.elapsed, reader.size)
+
+        if is_zero:
+            item.data = None
+            item.storage_name = _ZERO_BLOCK_NAME
+            return item
+
+        item.codec = codec
+        if auto_codec and not is_worth_compressing(samples, codec, level):
+            item.codec = get_codec('none')
+        item.storage_name = get_block_name(
+            storage, args, item.block_num, hashing.hexdigest(), item.codec)
+        if item.storage_name in index:
+            # It will not be stored, so let its data go now.
+            item.data = None
+        return item
+
+    def claim(name):
+        '''Return True if the named block should be stored by the
+        caller.'''
+        start = time.time()
+        with lock:
+            result = name not in index and name not in storing
+            if result:
+                storing.add(name)
+        stats.add('exists', time.time() - start)
+        return result
 
+    def upload_block(item):
+        attempts = 0
+        needs_store = (item.storage_name != _ZERO_BLOCK_NAME and
+                       claim(item.storage_name))
+        while needs_store:
+            source, from_device = read_block(item)
+            region = TimedReader(source)
+            hashing = HashingReader(region, hash_function)
+            reader = TimedReader(hashing)
+            compressed = TimedReader(item.codec.compress(reader, level))
+            start = time.time()
+            storage.store_stream(item.storage_name, compressed)
+            elapsed = time.time() - start
+            if from_device:
+                stats.add('read', region.elapsed, region.size)
+            stats.add('hash', reader.elapsed - region.elapsed, reader.size)
+            stats.add('compress', compressed.elapsed - reader.elapsed,
+                      reader.size)
+            stats.add('upload', elapsed - compressed.elapsed, compressed.size)
+            name = get_block_name(storage, args, item.block_num,
+                                  hashing.hexdigest(), item.codec)
+            if name == item.storage_name:
+                item.stored_size = compressed.size
+                item.new = True
+                index.add(name, compressed.size)
+                with lock:
+                    storing.discard(name)
+                break
+
+            # The device changed between hashing and storing this
+            # block.  Discard what was stored, and try again under the
+            # new name.
+            storage.remove(item.storage_name)
+            with lock:
+                storing.discard(item.storage_name)
+            attempts += 1
+            if attempts >= 3:
+                raise BackupError(
+                    'block %d is changing during backup' % item.block_num)
+            item.storage_name = name
+            needs_store = claim(name)
+
+        item.data = None
+        journal.record(item)
+        with lock:
+            backup_blocks[item.block_num] = item
+            completed[0] += item.length
+            progress.update(completed[0], size, 'storing blocks')
+
+    progress.update(completed[0], size, 'preparing blocks')
+    try:
+        if pipeline is None:
+            Pipeline([(prepare_block, args.jobs),
+                      (upload_block, args.upload_jobs)]).run(read_blocks())
+        else:
+            pipeline.run(read_blocks(), [prepare_block, upload_block])
+
+        # Make sure everything named is there before naming it in a
+        # manifest.  That includes blocks the index says earlier
+        # backups stored, which may since have been removed by another
+        # machine, so those missing are dropped from the index too.
+        referenced = set(item.storage_name
+                         for item in backup_blocks.itervalues()
+                         if item.storage_name != _ZERO_BLOCK_NAME)
+        progress.update(size, size, 'verifying blocks')
+        start = time.time()
+        missing, sizes = find_missing(storage, referenced, args.upload_jobs)
+        stats.add('verify', time.time() - start)
+        if missing:
+            index.discard(missing)
+            journal.discard(missing)
+            raise BackupError('blocks were not stored: %s' % ', '.join(
+                    "'%s'" % name for name in sorted(missing)))
+
+        # Blocks stored by earlier backups have their sizes recorded
+        # in the index, or failing that in the listing.
+        manifest_items = []
+        for block_num in sorted(backup_blocks):
+            item = backup_blocks[block_num]
+            stored_size = item.stored_size
+            if not item.new and item.storage_name != _ZERO_BLOCK_NAME:
+                stored_size = index.size(item.storage_name)
+                if stored_size is None:
+                    stored_size = sizes.get(item.storage_name)
+            manifest_items.append(ManifestItem(
+                    item.block_num, item.offset, item.length,
+                    item.storage_name, stored_size, item.new))
+    finally:
+        block.close()
+        index.close()
+        journal.close()
+
+    data_prefix = storage.prefix
+    if args.layout == 'content':
+        data_prefix = pool
+
+    # Everything the manifest names must be durable before it is.
+    storage.sync()
     manifest_name = create_manifest_name(storage)
-    storage.store(manifest_name, create_manifest(args, manifest_items))
+    manifest = create_manifest(args, manifest_items, data_prefix, size,
+                               hash_function)
+    storage.store(manifest_name, manifest)
+    # And the manifest must be durable before -current names it.
+    storage.sync()
+
+    open_manifest_cache(storage, args).store(manifest_name, manifest)
+    ref_counts = open_ref_counts(storage, args)
+    ref_counts.add(manifest_name, parse_manifest(manifest))
+    ref_counts.save()
 
     storage.store(get_current_name(storage), manifest_name)
+    storage.sync()
+    journal.remove()
 
     if args.verbose:
         print ' ' * 75,
@@ -299,86 +2710,665 @@ def do_backup(args):
     end_time = time.time()
     print "\nWrote backup to: '%s' in %d seconds" % (
         manifest_name, int(end_time - start_time))
+    save_stats(stats, args)
 
+    purged = []
     if args.limit is not None:
-        do_limit(storage, args)
+        purged = do_limit(storage, args)
         
     if args.cleanup:
-        do_cleanup(storage, args)
+        do_cleanup(storage, args, purged)
         
     return 0
 
 
-def do_restore(args):
-    storage = make_storage(args)
-    progress = Progress(args, 'restore')
-
-    if not args.manifest:
-        current_name = get_current_name(storage)
-        if not storage.exists(current_name):
-            print >>sys.stderr, 'no current backup found'
-            return 1
+class RestoreError(Exception):
+    pass
+
+
+def find_missing(storage, names, jobs):
+    '''Return the set of the given data block names which are missing
+    from storage, and a dictionary of the sizes of those present.
+
+    Each data prefix is listed once rather than asking after every
+    block.  Storage which cannot list is instead asked about each
+    block, jobs at a time, and no sizes are returned.'''
+    if not hasattr(storage, 'list_sizes'):
+        names = sorted(names)
+        return set(name for name, exists in
+                   zip(names, map_ahead(storage.exists, names, jobs))
+                   if not exists), {}
+
+    sizes = {}
+    for prefix in set(name[:name.rindex('-data-')] for name in names):
+        sizes.update(storage.list_sizes(prefix + '-data-'))
+    return set(name for name in names if name not in sizes), sizes
+
+
+def get_content_key(name):
+    '''Return what identifies the content of the named block, whatever
+    its layout or codec.'''
+    if name == _ZERO_BLOCK_NAME:
+        return name
+    return parse_block_name(name)[1]
+
+def load_restored_manifests(storage, args):
+    '''Return a dictionary mapping each device restored to on this
+    machine, and not changed by this script since, to the manifest it
+    holds.'''
+    path = get_state_path(storage, args, storage.prefix, '.restores')
+    if not os.path.exists(path):
+        return {}
+    f = open(path, 'r')
+    result = json.load(f)
+    f.close()
+    return result
 
-        manifest_name = storage.load(current_name)
+def save_restored_manifest(storage, args, manifest_name):
+    '''Record that the restore target holds manifest_name, or if it is
+    None, nothing known.'''
+    restored = load_restored_manifests(storage, args)
+    device = os.path.abspath(args.block)
+    if manifest_name is None:
+        restored.pop(device, None)
     else:
-        manifest_name = args.manifest
+        restored[device] = manifest_name
+
+    path = get_state_path(storage, args, storage.prefix, '.restores')
+    f = open(path + '.tmp', 'w')
+    json.dump(restored, f)
+    f.close()
+    os.rename(path + '.tmp', path)
+
+def load_restore_base(storage, args, cache):
+    '''Return the Manifest the restore target is known to hold, or None
+    if there is none.'''
+    name = args.base_manifest
+    if name == 'last':
+        name = load_restored_manifests(storage, args).get(
+            os.path.abspath(args.block))
+        if name is None and args.verbose:
+            print 'No earlier restore to this device is known'
+    if name is None:
+        return None
+    if name not in cache and not storage.exists(name):
+        print >>sys.stderr, \
+            "base manifest '%s' does not exist, checking every block" % name
+        return None
+    return cache.load(name)
+
+def get_restore_manifest_name(storage, args):
+    '''Return the name of the manifest to restore from, or None if
+    there is no current backup.'''
+    if args.manifest:
+        return args.manifest
+    current_name = get_current_name(storage)
+    if not storage.exists(current_name):
+        return None
+    return storage.load(current_name)
+
+def do_restore(args, storage=None):
+    if args.restore_to == '-':
+        # The device goes to standard output, so nothing else may.
+        output = sys.stdout
+        sys.stdout = sys.stderr
+        try:
+            return restore_device(args, storage, output)
+        finally:
+            sys.stdout = output
+
+    if args.restore_to is not None:
+        args.block = args.restore_to
+    return restore_device(args, storage)
+
+def restore_device(args, storage=None, output=None):
+    '''Restore to the -b device, or if output is given, write the
+    device to it from start to end.  The backup is read from storage
+    if it is given, or otherwise from that chosen by args.'''
+    if storage is None:
+        storage = make_storage(args)
+    progress = Progress(args, 'restore')
+    stats = open_stats(args, 'restore')
+
+    manifest_name = get_restore_manifest_name(storage, args)
+    if manifest_name is None:
+        print >>sys.stderr, 'no current backup found'
+        return 1
 
     if args.verbose:
         print "Restoring from: '%s'" % manifest_name
-    manifest = storage.load(manifest_name)
+    cache = open_manifest_cache(storage, args)
+    manifest = cache.load(manifest_name)
+    all_items = manifest_items = manifest.items
+    hash_function = get_manifest_hash_function(manifest, args.hash_jobs)
+
+    # When the target is known to hold an earlier backup, only the
+    # blocks which differ from it are restored, and unless --verify is
+    # given, none of the target is read.
+    base = None
+    if output is None:
+        base = load_restore_base(storage, args, cache)
+    if base is not None:
+        base_digests = dict((item.offset, (item.length, get_content_key(
+                        item.name))) for item in base.items)
+        manifest_items = [
+            item for item in manifest_items
+            if args.verify or base_digests.get(item.offset) != (
+                item.length, get_content_key(item.name))]
+        if args.verbose:
+            print 'Restoring %d blocks which differ from the base' % (
+                len(manifest_items))
+
+    # First verify that everything exists, before anything is written.
+    # Version 2 manifests are only written once every block they name
+    # has been found, but blocks in a pool shared with other devices or
+    # machines may have been removed since, and a single listing costs
+    # little, so they are checked too.
+    progress.update(0, 0, 'verifying data')
+    start = time.time()
+    missing, sizes = find_missing(
+        storage, set(item.name for item in manifest_items
+                     if item.name != _ZERO_BLOCK_NAME), args.prefetch)
+    stats.add('exists', time.time() - start)
+    if missing:
+        for name in sorted(missing):
+            print >>sys.stderr, "data file '%s' does not exist" % name
+        return 1
 
-    manifest_items, block_size = parse_manifest(manifest)
-    num_blocks = len(manifest_items)
+    # Progress is measured in stored bytes, so that zero blocks and
+    # those already present locally do not skew the estimate.  Where
+    # the stored size is unknown, the block length stands in for it.
+    def stored_size(item):
+        if item.name == _ZERO_BLOCK_NAME:
+            return 0
+        if item.stored_size is not None:
+            return item.stored_size
+        return sizes.get(item.name, item.length)
+
+    download_total = sum(stored_size(item) for item in manifest_items)
+    if args.verbose:
+        print 'Up to %d bytes to download in %d blocks' % (
+            download_total, len(manifest_items))
+
+    if output is not None:
+        result = stream_restore(storage, args, manifest_items, output,
+                                lambda count: progress.update(
+                count, download_total, 'restoring'), stored_size,
+                                hash_function, stats)
+        if result == 0:
+            save_stats(stats, args)
+        return result
 
-    # First verify that everything exists.
-    progress.update(0, 0, 'verifying data')
-    for item in manifest_items:
-        if not storage.exists(item):
-            print >>sys.stderr, "data file '%s' does not exist" % item
+    # Until this restore completes, the target holds no known backup.
+    save_restored_manifest(storage, args, None)
+
+    block = PositionalFile(args.block, writable=True, direct=args.direct_io)
+    if manifest.size is not None:
+        block.extend(manifest.size)
+
+    # Local regions are hashed by one pool of workers, and any blocks
+    # which differ are streamed down and decompressed by a second,
+    # with each piece written at its own offset as it arrives.
+    completed = [0]
+    lock = threading.Lock()
+    total = sum(item.length for item in all_items)
+    check_target = base is None or args.verify
+
+    def block_done(item):
+        with lock:
+            completed[0] += stored_size(item)
+            progress.update(completed[0], download_total, 'restoring')
+
+    def check_block(item):
+        if item.name == _ZERO_BLOCK_NAME:
+            # Zero blocks are never downloaded, and if the region does
+            # not already read as zeros, it is punched out where
+            # possible rather than written.
+            block.write_zeros(item.offset, item.length, check=check_target)
+            block_done(item)
+            return None
+
+        if not check_target:
+            return item
+
+        region = TimedReader(RegionReader(block, item.offset, item.length))
+        start = time.time()
+        name, length = hash_stream(region, hash_function)
+        stats.add('read', region.elapsed, region.size)
+        stats.add('hash', time.time() - start - region.elapsed, region.size)
+
+        if block_name_matches(item.name, item.block_num, name):
+            block_done(item)
+            return None
+        return item
+
+    def fetch_block(item):
+        spool = tempfile.SpooledTemporaryFile(_RESTORE_SPOOL_MEMORY)
+        try:
+            start = time.time()
+            source = TimedReader(storage.load_stream(item.name))
+            source.elapsed = time.time() - start
+            try:
+                decompressed = TimedReader(
+                    get_block_codec(item.name).decompress(source))
+                hashing = HashingReader(decompressed, hash_function)
+                reader = TimedReader(hashing)
+                while True:
+                    position = reader.size
+                    data = reader.read(_CHUNK_SIZE)
+                    if not data:
+                        break
+                    # Never keep more than this block, even if the
+                    # stored data is too long.
+                    data = data[:max(0, item.length - position)]
+                    if data:
+                        spool.write(data)
+            finally:
+                source.close()
+            stats.add('download', source.elapsed, source.size)
+            stats.add('decompress', decompressed.elapsed - source.elapsed,
+                      decompressed.size)
+            stats.add('hash', reader.elapsed - decompressed.elapsed,
+                      reader.size)
+
+            if not block_name_matches(
+                item.name, item.block_num, hashing.hexdigest()):
+                raise RestoreError("Checksum error at item '%s'" %
+                                   item.name)
+
+            if item.length != hashing.size:
+                raise RestoreError("Size mismatch at item '%s'" %
+                                   item.name)
+
+            spool.seek(0)
+            start = time.time()
+            position = 0
+            while True:
+                data = spool.read(_CHUNK_SIZE)
+                if not data:
+                    break
+                block.pwrite(item.offset + position, data)
+                position += len(data)
+            stats.add('write', time.time() - start, position)
+        finally:
+            spool.close()
+        block_done(item)
+
+    progress.update(0, download_total, 'restoring')
+    pipeline = Pipeline([(check_block, args.jobs),
+                         (fetch_block, args.prefetch)])
+    try:
+        pipeline.run(manifest_items)
+        # Trailing zero blocks may not have extended a new file.
+        block.extend(total)
+    except RestoreError, e:
+        print >> sys.stderr, str(e)
+        return 1
+    finally:
+        block.close()
+
+    save_restored_manifest(storage, args, manifest_name)
+    save_stats(stats, args)
+    return 0
+
+def stream_restore(storage, args, manifest_items, output, progress,
+                   stored_size, hash_function, stats):
+    '''Write the blocks of manifest_items to output in order.  Up to
+    --prefetch blocks are downloaded and decompressed ahead of the one
+    being written, so no more than that are held in memory.'''
+    def fetch(item):
+        if item.name == _ZERO_BLOCK_NAME:
+            return item, None
+        return item, load_block(storage, item, hash_function, stats)
+
+    completed = 0
+    try:
+        for item, data in map_ahead(fetch, manifest_items, args.prefetch):
+            start = time.time()
+            if data is None:
+                zeros = '\0' * min(item.length, _CHUNK_SIZE)
+                for offset in range(0, item.length, len(zeros)):
+                    output.write(zeros[:item.length - offset])
+            else:
+                output.write(data)
+            stats.add('write', time.time() - start, item.length)
+            completed += stored_size(item)
+            progress(completed)
+        output.flush()
+    except RestoreError, e:
+        print >> sys.stderr, str(e)
+        return 1
+    except IOError, e:
+        if e.errno != errno.EPIPE:
+            raise
+        print >> sys.stderr, 'output closed before the restore completed'
+        return 1
+    return 0
+
+def load_block(storage, item, hash_function, stats=None):
+    '''Return the contents of the data block for one ManifestItem,
+    having checked them against its name with hash_function.'''
+    start = time.time()
+    source = TimedReader(storage.load_stream(item.name))
+    source.elapsed = time.time() - start
+    try:
+        decompressed = TimedReader(
+            get_block_codec(item.name).decompress(source))
+        reader = HashingReader(decompressed, hash_function)
+        hashed = TimedReader(reader)
+        data = ''.join(iter(lambda: hashed.read(_CHUNK_SIZE), ''))
+    finally:
+        source.close()
+
+    if stats is not None:
+        stats.add('download', source.elapsed, source.size)
+        stats.add('decompress', decompressed.elapsed - source.elapsed,
+                  decompressed.size)
+        stats.add('hash', hashed.elapsed - decompressed.elapsed, hashed.size)
+
+    if not block_name_matches(item.name, item.block_num, reader.hexdigest()):
+        raise RestoreError("Checksum error at item '%s'" % item.name)
+    if item.length != len(data):
+        raise RestoreError("Size mismatch at item '%s'" % item.name)
+    return data
+
+
+class BackupReader(object):
+    '''Random access to the device saved in one backup, fetching only
+    the blocks which are read.  The most recently used blocks are kept
+    decompressed, up to cache_size bytes, and while reads are
+    sequential, up to prefetch of the blocks which follow are fetched
+    in the background.'''
+
+    def __init__(self, storage, manifest, cache_size=_DEFAULT_CACHE_SIZE,
+                 prefetch=_DEFAULT_PREFETCH):
+        self._storage = storage
+        self._items = manifest.items
+        self._hash_function = get_manifest_hash_function(manifest)
+        self._offsets = [item.offset for item in self._items]
+        self.size = manifest.size
+        if self.size is None:
+            self.size = sum(item.length for item in self._items)
+        self._cache_size = cache_size
+        self._prefetch = prefetch
+
+        self._lock = threading.Lock()
+        # Blocks by name, least recently used first.
+        self._cache = collections.OrderedDict()
+        self._cache_bytes = 0
+        # An event for each block being fetched, set once it is done.
+        self._fetching = {}
+        self._next_offset = None
+        self._tasks = Queue.Queue()
+        self._threads = []
+
+    def read(self, offset, length):
+        '''Return length bytes starting at offset, or fewer at the end
+        of the device.'''
+        end = min(offset + length, self.size)
+        sequential = offset == self._next_offset
+        self._next_offset = end
+
+        result = []
+        index = bisect.bisect_right(self._offsets, offset) - 1
+        while offset < end:
+            item = self._items[index]
+            count = min(end, item.offset + item.length) - offset
+            if item.name == _ZERO_BLOCK_NAME:
+                result.append('\0' * count)
+            else:
+                start = offset - item.offset
+                result.append(self._get(item)[start:start + count])
+            offset += count
+            index += 1
+
+        if sequential:
+            for item in self._items[index:index + self._prefetch]:
+                self._schedule(item)
+        return ''.join(result)
+
+    def _get(self, item):
+        while True:
+            with self._lock:
+                data = self._cache.pop(item.name, None)
+                if data is not None:
+                    self._cache[item.name] = data
+                    return data
+                event = self._fetching.get(item.name)
+                if event is None:
+                    event = self._fetching[item.name] = threading.Event()
+                    break
+            # Someone else is fetching it.
+            event.wait()
+        return self._fetch(item, event)
+
+    def _fetch(self, item, event):
+        try:
+            data = load_block(self._storage, item, self._hash_function)
+            with self._lock:
+                self._cache[item.name] = data
+                self._cache_bytes += len(data)
+                while self._cache_bytes > self._cache_size and \
+                        len(self._cache) > 1:
+                    name, old = self._cache.popitem(last=False)
+                    self._cache_bytes -= len(old)
+            return data
+        finally:
+            with self._lock:
+                del self._fetching[item.name]
+            event.set()
+
+    def _schedule(self, item):
+        with self._lock:
+            if item.name == _ZERO_BLOCK_NAME or item.name in self._cache or \
+                    item.name in self._fetching:
+                return
+            event = self._fetching[item.name] = threading.Event()
+            if len(self._threads) < self._prefetch:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        self._tasks.put((item, event))
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            if task is _STOP:
+                break
+            try:
+                self._fetch(*task)
+            except Exception:
+                # A failed prefetch is retried, and reported, when the
+                # block is read.
+                pass
+
+    def close(self):
+        for thread in self._threads:
+            self._tasks.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+
+def do_extract(args):
+    storage = make_storage(args)
+    manifest_name = get_restore_manifest_name(storage, args)
+    if manifest_name is None:
+        print >>sys.stderr, 'no current backup found'
+        return 1
+
+    manifest = open_manifest_cache(storage, args).load(manifest_name)
+    reader = BackupReader(storage, manifest, parse_size(args.cache_size),
+                          args.prefetch)
+    offset, length = args.extract_range
+    output = sys.stdout
+    if args.block is not None:
+        output = open(args.block, 'wb')
+    try:
+        end = min(offset + length, reader.size)
+        while offset < end:
+            data = reader.read(offset, min(_CHUNK_SIZE, end - offset))
+            output.write(data)
+            offset += len(data)
+    except RestoreError, e:
+        print >> sys.stderr, str(e)
+        return 1
+    finally:
+        reader.close()
+        if output is not sys.stdout:
+            output.close()
+    return 0
+
+def parse_workers(option, opt_str, value, parser):
+    '''Accept a number of worker threads, which must be at least one,
+    as with none nothing would ever be done.'''
+    import optparse
+    if value < 1:
+        raise optparse.OptionValueError('%s must be at least 1' % opt_str)
+    setattr(parser.values, option.dest, value)
+
+def parse_extract_range(option, opt_str, value, parser):
+    offset, length = value.split(':')
+    parser.values.extract_range = (parse_size(offset), parse_size(length))
+    parser.values.ensure_value('func', []).append(do_extract)
+
+def verify_block(storage, item, hash_function, throttle=None):
+    '''Check the data block for one ManifestItem against its name with
+    hash_function, raising RestoreError if it does not match.  The
+    block is streamed rather than held in memory.'''
+    source = storage.load_stream(item.name)
+    try:
+        if throttle is not None:
+            source = ThrottledReader(source, throttle)
+        reader = HashingReader(get_block_codec(item.name).decompress(source),
+                               hash_function)
+        while reader.read(_CHUNK_SIZE):
+            pass
+    finally:
+        source.close()
+
+    if not block_name_matches(item.name, item.block_num, reader.hexdigest()):
+        raise RestoreError("Checksum error at item '%s'" % item.name)
+    if item.length != reader.size:
+        raise RestoreError("Size mismatch at item '%s'" % item.name)
+
+def load_verified_blocks(storage, args):
+    '''Return a dictionary mapping the name of each data block a scrub
+    found intact to the time it did so.'''
+    path = get_state_path(storage, args, storage.prefix, '.scrub')
+    if not os.path.exists(path):
+        return {}
+    f = open(path, 'r')
+    result = json.load(f)
+    f.close()
+    return result
+
+def save_verified_blocks(storage, args, verified):
+    path = get_state_path(storage, args, storage.prefix, '.scrub')
+    f = open(path + '.tmp', 'w')
+    json.dump(verified, f)
+    f.close()
+    os.rename(path + '.tmp', path)
+
+def parse_sample(text):
+    '''Parse a --sample percentage such as 5%.'''
+    result = float(text.strip().rstrip('%'))
+    if not 0 < result <= 100:
+        raise ValueError('sample must be between 0 and 100%')
+    return result
+
+def do_scrub(args, storage=None):
+    '''Check the stored blocks of the --manifest backup, or of every
+    backup, against their names without restoring them.  Blocks
+    verified within --scrub-interval days are skipped, and with
+    --sample, only that share of all the blocks is checked.'''
+    sample = None
+    if args.sample is not None:
+        try:
+            sample = parse_sample(args.sample)
+        except ValueError:
+            print >> sys.stderr, "invalid --sample '%s'" % args.sample
             return 1
 
-    if not os.path.exists(args.block):
-        block = open(args.block, 'w+b')
-    else:
-        block = open(args.block, 'r+b')
-    
-    for block_num, item in enumerate(manifest_items):
-        progress.update(block_num * block_size, num_blocks * block_size,
-                        'restoring')
-        offset = block_size * block_num
-        block.seek(offset)
-
-        to_read = block_size
-
-        existing_data = block.read(to_read)
-        hasher = _HASH_FUNCTION()
-        hasher.update(existing_data)
-        name = hasher.hexdigest()
-
-        if get_canonical_block_name(storage, block_num, name) != item:
-            def update_progress(count, total):
-                scaled = block_size * float(count) / float(total)
-                progress.update(block_num * block_size + scaled,
-                                num_blocks * block_size,
-                                'reading block')
-            # We need to restore this data.
-            compressed = storage.load(item, update_progress)
-            f = gzip.GzipFile(mode='rb', fileobj=cStringIO.StringIO(compressed))
-            data = f.read()
-            f.close()
+    if storage is None:
+        storage = make_storage(args)
+    progress = Progress(args, 'scrub')
+    throttle = None
+    if args.bandwidth is not None:
+        throttle = Throttle(parse_size(args.bandwidth))
 
-            hasher = _HASH_FUNCTION()
-            hasher.update(data)
-            checksum = hasher.hexdigest()
-            if get_canonical_block_name(storage, block_num, checksum) != item:
-                print >> sys.stderr, "Checksum error at item '%s'" % item
-                return 1
-            
-            if block_size != len(data):
-                print >> sys.stderr, "Size mismatch at item '%s'" % item
-                return 1
-            block.seek(offset)
-            block.write(data)
+    if args.manifest:
+        manifest_names = [args.manifest]
+    else:
+        manifest_names = sorted(storage.list(storage.prefix + '-manifest-'))
+
+    # Blocks shared between backups are checked once.
+    cache = open_manifest_cache(storage, args)
+    blocks = {}
+    for manifest_name in manifest_names:
+        manifest = cache.load(manifest_name)
+        hash_function = get_manifest_hash_function(manifest)
+        for item in manifest.items:
+            if item.name != _ZERO_BLOCK_NAME and item.name not in blocks:
+                blocks[item.name] = (item, hash_function)
+
+    verified = load_verified_blocks(storage, args)
+    if not args.manifest:
+        # Forget blocks no backup uses any more.
+        for name in set(verified) - set(blocks):
+            del verified[name]
+
+    now = time.time()
+    since = now - args.scrub_interval * 24 * 3600
+    due = sorted(name for name in blocks if verified.get(name, 0) <= since)
+    if sample is not None:
+        count = int(math.ceil(len(blocks) * sample / 100))
+        due = sorted(random.sample(due, min(count, len(due))))
+    scrubbed = len(due)
+
+    missing, sizes = find_missing(storage, due, args.prefetch)
+    errors = ["data file '%s' does not exist" % name
+              for name in sorted(missing)]
+    for name in due:
+        item = blocks[name][0]
+        if name in sizes and item.stored_size is not None and \
+                sizes[name] != item.stored_size:
+            errors.append("Stored size mismatch at item '%s'" % name)
+            missing.add(name)
+    for name in missing:
+        verified.pop(name, None)
+    due = [name for name in due if name not in missing]
+
+    def check(name):
+        item, hash_function = blocks[name]
+        try:
+            verify_block(storage, item, hash_function, throttle)
+        except RestoreError, e:
+            return str(e)
+        except Exception, e:
+            return "could not read item '%s': %s" % (name, e)
+        return None
+
+    total = len(due)
+    checked = 0
+    try:
+        for name, error in zip(due, map_ahead(check, due, args.prefetch)):
+            if error is None:
+                verified[name] = now
+            else:
+                errors.append(error)
+                verified.pop(name, None)
+            checked += 1
+            progress.update(checked, total, 'scrubbing')
+    finally:
+        save_verified_blocks(storage, args, verified)
+
+    for error in errors:
+        print >> sys.stderr, error
+    print 'Scrubbed %d of %d blocks, %d errors' % (
+        scrubbed, len(blocks), len(errors))
+    return errors and 1 or 0
 
 def do_list(args):
     storage = make_storage(args)
@@ -390,37 +3380,202 @@ def do_list(args):
         do_cleanup(storage, args)
     return 0
 
+class JobError(Exception):
+    pass
+
+
+def read_job_file(args):
+    '''Return the name and arguments of each device in the --job-file.
+    Each section of the file is one device, holding long options such
+    as block and prefix as keys.  The options of the DEFAULT section
+    and of the command line apply to every device.'''
+    import ConfigParser
+
+    config = ConfigParser.RawConfigParser()
+    try:
+        if not config.read(args.job_file):
+            raise JobError("could not read job file '%s'" % args.job_file)
+    except ConfigParser.Error, e:
+        raise JobError("could not parse job file '%s': %s" % (
+                args.job_file, e))
+
+    parser = make_parser()
+    sub_commands = set(parser.option_groups[0].option_list)
+    result = []
+    for section in config.sections():
+        argv = []
+        for key, value in config.items(section):
+            option = parser.get_option('--' + key.replace('_', '-'))
+            if option is None or option in sub_commands:
+                raise JobError("unknown option '%s' for device '%s'" % (
+                        key, section))
+            if option.takes_value():
+                argv.extend([option.get_opt_string(), value])
+            elif config.getboolean(section, key):
+                argv.append(option.get_opt_string())
+        device_args, extra = parser.parse_args(argv, copy.copy(args))
+        if device_args.block is None:
+            raise JobError("no block device for device '%s'" % section)
+        result.append((section, device_args))
+    if not result:
+        raise JobError("no devices in job file '%s'" % args.job_file)
+    return result
+
+def parse_job_file(option, opt_str, value, parser):
+    parser.values.job_file = value
+    parser.values.ensure_value('func', []).append(do_job)
+
+def do_job(args):
+    '''Back up every device in the --job-file at once, with one pool of
+    workers and S3 connections shared between them.  Each device's
+    --limit is applied once all are done, and then one --cleanup pass
+    is made over each storage rather than one per device.'''
+    try:
+        devices = read_job_file(args)
+    except JobError, e:
+        print >> sys.stderr, str(e)
+        return 1
+
+    connections = {}
+    storages = [make_storage(device_args, connections)
+                for name, device_args in devices]
+    pipeline = SharedPipeline([args.jobs, args.upload_jobs])
+    results = {}
+
+    def backup(name, device_args, storage):
+        # Limits and cleanup wait until every backup is done.
+        device_args = copy.copy(device_args)
+        device_args.limit = None
+        device_args.cleanup = False
+        try:
+            results[name] = do_backup(device_args, storage, pipeline)
+        except Exception, e:
+            print >> sys.stderr, "backup of '%s' failed: %s" % (name, e)
+            results[name] = 1
+
+    threads = [threading.Thread(target=backup,
+                                args=(name, device_args, storage))
+               for (name, device_args), storage in zip(devices, storages)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.5)
+    finally:
+        pipeline.close()
+
+    # Devices are cleaned up together when they are in the same
+    # storage.  An interrupted backup may be resumed, so nothing is
+    # cleaned up in a storage where one failed.
+    purged = collections.defaultdict(list)
+    cleanups = collections.OrderedDict()
+    failed = set()
+    for (name, device_args), storage in zip(devices, storages):
+        if results[name] != 0:
+            failed.add(storage.location)
+            continue
+        if device_args.limit is not None:
+            purged[storage.location].extend(do_limit(storage, device_args))
+        if device_args.cleanup:
+            cleanups.setdefault(storage.location, []).append(
+                (device_args, storage))
+
+    result = failed and 1 or 0
+    for location, group in cleanups.iteritems():
+        if location in failed:
+            print >> sys.stderr, "not cleaning up '%s' after a failed " \
+                "backup" % location
+            continue
+        data_prefixes = sorted(set(
+                prefix for device_args, storage in group
+                for prefix in [storage.prefix, get_pool(storage, device_args)]))
+        device_args, storage = group[0]
+        if do_cleanup(storage, device_args, purged[location], data_prefixes):
+            result = 1
+    return result
+
 def do_version(args):
     print 's3bdbk.py version %s' % _S3BDBK_VERSION
     print 'Copyright 2011-2015 Josh Pieper'
     print
     return 0
 
-def do_cleanup(storage, args):
+def get_pool_manifests(storage, pool):
+    '''Return the names of every manifest which may reference blocks
+    stored under the pool prefix.'''
+    marker = get_pool_member_name(pool, '')
+    prefixes = set([pool] + [name[len(marker):]
+                             for name in storage.list(marker)])
+    result = []
+    for prefix in sorted(prefixes):
+        result.extend(storage.list(prefix + '-manifest-'))
+    return result
+
+def do_cleanup(storage, args, purged=[], data_prefixes=None):
+    '''Remove the data blocks no manifest references.  With --dry-run,
+    the manifests purged are those --limit would have removed.  Giving
+    the data_prefixes of several devices in the same storage cleans
+    up after all of them in one pass.'''
     if args.verbose:
         print 'Starting cleanup process.'
 
-    # First, check out all the objects we have right now.
-    data_files = set(storage.list(storage.prefix + '-data-'))
-
-    # Look to see which ones we care about by aggregative all the
-    # active manifests together.
-    required_files = set()
-    manifests = storage.list(storage.prefix + '-manifest-')
-    for manifest_name in manifests:
-        items, ignored = parse_manifest(storage.load(manifest_name))
-        required_files.update(items)
+    state_prefix = storage.prefix
+    if data_prefixes is None:
+        # Blocks may be stored positionally under our own prefix, and
+        # content addressed under the pool prefix.
+        data_prefixes = sorted(set([storage.prefix, get_pool(storage, args)]))
+    else:
+        state_prefix = ','.join(data_prefixes)
 
-    data_files.difference_update(required_files)
+    # First, check out all the objects we have right now.
+    data_sizes = {}
+    for prefix in data_prefixes:
+        data_sizes.update(storage.list_sizes(prefix + '-data-'))
+
+    # Look to see which ones we care about by counting the references
+    # from all the active manifests, including those of any other
+    # devices sharing our blocks.  Only manifests not seen by an
+    # earlier backup or cleanup on this machine need be read.
+    manifests = set()
+    for prefix in data_prefixes:
+        manifests.update(get_pool_manifests(storage, prefix))
+    cache = open_manifest_cache(storage, args, state_prefix)
+    ref_counts = open_ref_counts(storage, args, state_prefix)
+    ref_counts.sync(manifests, cache, args.manifest_jobs)
+    ref_counts.save()
+
+    if args.dry_run:
+        for name in purged:
+            ref_counts.remove(name, cache.load(name))
+
+    data_files = set(data_sizes)
+    data_files.difference_update(ref_counts.referenced())
+    reclaimed = sum(data_sizes[name] for name in data_files)
 
     # Now data_files contains all the unreferenced data blocks.
+    if args.dry_run:
+        print 'Would prune %d unused data files, reclaiming %d bytes' % (
+            len(data_files), reclaimed)
+        return 0
+
     if args.verbose:
-        print 'Pruning %d unused data files...' % len(data_files)
-    
-    for data_file in data_files:
-        storage.remove(data_file)
-    
-    return 0
+        print 'Pruning %d unused data files, reclaiming %d bytes...' % (
+            len(data_files), reclaimed)
+
+    # Forget the blocks before removing them, so that an interrupted
+    # cleanup cannot leave the index naming blocks which are gone.
+    for prefix in data_prefixes:
+        index_path = get_state_path(storage, args, prefix, '.index')
+        if os.path.exists(index_path):
+            index = BlockIndex(storage, prefix, index_path)
+            index.discard(data_files)
+            index.close()
+
+    errors = storage.remove_many(data_files)
+    report_remove_errors(errors)
+    return errors and 1 or 0
 
 manifest_re = re.compile('manifest-(\d{8})-(\d{6})-[^-]+$')
 
@@ -437,65 +3592,177 @@ def total_seconds(td):
     return ((td.microseconds +
              (td.seconds + td.days * 24 * 3600) * 10**6) / float(10**6))
 
-def calculate_manifest_weight(most_recent, previous, current):
-    previous_date = date_from_manifest(previous)
-    current_date = date_from_manifest(current)
-    delta = abs(current_date - previous_date)
-    dt = total_seconds(delta)
-
-    recent_date = date_from_manifest(most_recent)
-    age = total_seconds(abs(recent_date - current_date))
+def get_manifest_weight(recent_time, previous_time, time):
+    '''Return how readily to remove a backup made at time, whose
+    predecessor was made at previous_time, when the most recent was
+    made at recent_time, all in seconds.  Backups close to their
+    predecessor, and old ones, are removed first.  A backup made in
+    the same second as its predecessor has no weight.'''
+    dt = abs(time - previous_time)
     if dt == 0:
         return 0.0
+    age = abs(recent_time - previous_time)
     return (1 / dt) ** 2 * (age ** 0.5)
 
-def weighted_choice_sub(weights):
-    rnd = random.random() * sum(weights)
-    for i, w in enumerate(weights):
-        rnd -= w
-        if rnd < 0:
-            return i
-
-def select_manifest_to_remove(manifests):
-    # Apply a weighted random selection process.  The weight for each
-    # manifest is:
-    #
-    # (1/t)**2
-    #  t=time in seconds since next prior backup
-
-    manifests = sorted(manifests)
-    weights = [calculate_manifest_weight(
-            manifests[-1], manifests[i], manifests[i - 1])
-               for i in range(1, len(manifests) - 1)]
-
-    # We cannot remove the first or last manifest.
-    manifests = manifests[1:-1]
+def calculate_manifest_weight(most_recent, previous, current):
+    epoch = datetime.datetime(1970, 1, 1)
+    times = [total_seconds(date_from_manifest(x) - epoch)
+             for x in [most_recent, current, previous]]
+    return get_manifest_weight(*times)
+
+
+class RetentionPlanner(object):
+    '''Chooses backups to remove, by repeated weighted random
+    selection.  The weight of each is that of get_manifest_weight(),
+    and the first and last are never removed.
+
+    Each date is parsed once, and the weights are kept in a Fenwick
+    tree, so that a selection takes O(log n) time, and a removal
+    changes only the weight of the backup after it.  Backups with no
+    weight, made in the same second as their predecessor, are removed
+    before any other.'''
+
+    def __init__(self, manifests):
+        self.manifests = sorted(manifests)
+        epoch = datetime.datetime(1970, 1, 1)
+        count = len(self.manifests)
+        self._times = array.array('d', [
+                total_seconds(date_from_manifest(x) - epoch)
+                for x in self.manifests])
+        self._previous = range(-1, count - 1)
+        self._next = range(1, count + 1)
+        self._weights = array.array('d', [0.0] * count)
+        self._tree = array.array('d', [0.0] * (count + 1))
+        self._duplicates = set()
+        self._total = 0.0
+        self.remaining = count
+        for index in range(1, count - 1):
+            self._update(index)
+
+    def _add(self, index, delta):
+        self._total += delta
+        position = index + 1
+        while position < len(self._tree):
+            self._tree[position] += delta
+            position += position & -position
+
+    def _update(self, index):
+        previous = self._previous[index]
+        weight = get_manifest_weight(self._times[-1], self._times[previous],
+                                     self._times[index])
+        if weight == 0.0:
+            self._duplicates.add(index)
+        else:
+            self._duplicates.discard(index)
+        self._add(index, weight - self._weights[index])
+        self._weights[index] = weight
+
+    def _find(self, value):
+        '''Return the first index at which the running total of the
+        weights exceeds value.'''
+        position = 0
+        step = 1
+        while step * 2 < len(self._tree):
+            step *= 2
+        while step:
+            if position + step < len(self._tree) and \
+                    self._tree[position + step] <= value:
+                position += step
+                value -= self._tree[position]
+            step /= 2
+        return position
+
+    def select(self):
+        '''Return the index of the next backup to remove, or None if
+        only the first and last remain.'''
+        if self.remaining <= 2:
+            return None
+        if self._duplicates:
+            return min(self._duplicates)
+        while True:
+            index = self._find(random.random() * self._total)
+            # Removed backups may retain a little weight from rounding.
+            if index < len(self._weights) and self._weights[index] > 0:
+                return index
+
+    def remove(self, index):
+        previous = self._previous[index]
+        following = self._next[index]
+        self._next[previous] = following
+        self._previous[following] = previous
+        self._duplicates.discard(index)
+        self._add(index, -self._weights[index])
+        self._weights[index] = 0.0
+        self.remaining -= 1
+        if following < len(self.manifests) - 1:
+            self._update(following)
+
+    def plan(self, limit):
+        '''Return the names of the backups to remove, in order, to
+        keep no more than limit, or at least the first and last.'''
+        result = []
+        while self.remaining > limit:
+            index = self.select()
+            if index is None:
+                break
+            self.remove(index)
+            result.append(self.manifests[index])
+        return result
 
-    index = weighted_choice_sub(weights)
-    return manifests[index]
 
-    
+def select_manifest_to_remove(manifests):
+    '''Return one of manifests, chosen as RetentionPlanner would.'''
+    planner = RetentionPlanner(manifests)
+    index = planner.select()
+    if index is None:
+        return None
+    return planner.manifests[index]
 
 def do_limit(storage, args):
     limit = int(args.limit)
     
     manifests = sorted(storage.list(storage.prefix + '-manifest-'))
-    if len(manifests) < limit:
-        return
+    if len(manifests) <= limit:
+        return []
 
     print 'Existing backups exceed limit, %d > %d' % (
         len(manifests), limit)
     if args.verbose:
         print ''.join(['  %s\n' % x for x in manifests])
 
-    while len(manifests) > limit:
-        to_remove = select_manifest_to_remove(manifests)
-        print "Purging old backup manifest: '%s'" % to_remove
-        storage.remove(to_remove)
-        manifests.remove(to_remove)
+    # Every removal is planned before any is made.
+    removed = RetentionPlanner(manifests).plan(limit)
+    for name in removed:
+        if args.dry_run:
+            print "Would purge old backup manifest: '%s'" % name
+        else:
+            print "Purging old backup manifest: '%s'" % name
+
+    if args.dry_run:
+        return removed
+
+    # The manifests are removed before their references are dropped,
+    # so that their blocks are never counted as unused while they
+    # remain.
+    errors = storage.remove_many(removed)
+    report_remove_errors(errors)
+
+    cache = open_manifest_cache(storage, args)
+    ref_counts = open_ref_counts(storage, args)
+    for name in removed:
+        if name not in errors:
+            if name in ref_counts.manifests:
+                ref_counts.remove(name, cache.load(name))
+            cache.discard(name)
+    ref_counts.save()
+    return [name for name in removed if name not in errors]
+
+def report_remove_errors(errors):
+    for name in sorted(errors):
+        print >>sys.stderr, "could not remove '%s': %s" % (name, errors[name])
         
 
-def main():
+def make_parser():
     import optparse
     parser = optparse.OptionParser(
         description='Save/restore block devices to remote storage.')
@@ -504,17 +3771,146 @@ def main():
     parser.add_option('-b','--block', help='block device')
     parser.add_option('-d','--directory',
                         help='destination directory (not S3)')
+    parser.add_option('--directory-layout', type='choice',
+                      choices=['flat', 'sharded'], default='flat',
+                      help='write data blocks to the -d directory itself ' +
+                      '(flat), or to subdirectories by hash (sharded).  ' +
+                      'Both are always read.  [default: %default]')
     parser.add_option('--manifest', help='restore from a specific manifest')
+    parser.add_option('--restore-to', metavar='TARGET',
+                      help='restore to TARGET instead of the -b device, ' +
+                      'or with -, write the device to standard output')
+    parser.add_option('--base-manifest',
+                      help='during restore, assume the target already ' +
+                      'holds this backup, and write only the blocks ' +
+                      'which differ from it.  "last" is the last backup ' +
+                      'restored to the target from this machine')
+    parser.add_option('--verify', action='store_true',
+                      help='with --base-manifest, still check every ' +
+                      'block of the target')
+    parser.add_option('--cache-size', default=str(_DEFAULT_CACHE_SIZE),
+                      help='bytes of decompressed blocks to keep in ' +
+                      'memory when extracting (default %default)')
+    parser.add_option('--stats-file',
+                      help='write the time and bytes of each stage of ' +
+                      'a backup or restore to this file as JSON')
+    parser.add_option('--stats-interval', type='float', metavar='SECONDS',
+                      help='write a JSON line of the stage totals so far ' +
+                      'to stderr this often')
+    parser.add_option('--resume', action='store_true',
+                      help='continue an interrupted backup of the same ' +
+                      'device, rather than starting again')
+    parser.add_option('--scrub-interval', type='float',
+                      default=_DEFAULT_SCRUB_INTERVAL, metavar='DAYS',
+                      help='during scrub, skip blocks verified within ' +
+                      'this many days (default %default)')
+    parser.add_option('--sample', metavar='PERCENT',
+                      help='during scrub, check only this share of the ' +
+                      'blocks, like 5%')
+    parser.add_option('--bandwidth', metavar='RATE',
+                      help='during scrub, download no more than this ' +
+                      'many bytes a second, like 10M')
     parser.add_option('--cleanup', action='store_true',
                       help='purge unreferenced blocks ' +
                       '(only after backup/list)')
+    parser.add_option('--dry-run', action='store_true',
+                      help='report what --limit and --cleanup would ' +
+                      'remove, and the space reclaimed, without ' +
+                      'removing anything')
     parser.add_option('-l', '--limit', help='purge to keep no more than ' +
                       'this many backups')
     
+    parser.add_option('-j', '--jobs', type='int',
+                      action='callback', callback=parse_workers,
+                      default=_DEFAULT_JOBS,
+                      help='number of threads hashing and compressing ' +
+                      'blocks (default %default)')
+    parser.add_option('--upload-jobs', type='int',
+                      action='callback', callback=parse_workers,
+                      default=_DEFAULT_UPLOAD_JOBS,
+                      help='number of threads uploading blocks ' +
+                      '(default %default)')
+    parser.add_option('--direct-io', action='store_true', default=False,
+                      help='read the device without filling the page ' +
+                      'cache, using O_DIRECT where supported')
+    parser.add_option('--prefetch', type='int',
+                      action='callback', callback=parse_workers,
+                      default=_DEFAULT_PREFETCH,
+                      help='number of blocks to download at once during ' +
+                      'restore or scrub (default %default)')
+    parser.add_option('--manifest-jobs', type='int',
+                      action='callback', callback=parse_workers,
+                      default=_DEFAULT_MANIFEST_JOBS,
+                      help='number of manifests to load at once during ' +
+                      'cleanup (default %default)')
+    parser.add_option('--part-jobs', type='int',
+                      action='callback', callback=parse_workers,
+                      default=_DEFAULT_PART_JOBS,
+                      help='number of parts of each S3 object to upload ' +
+                      'at once (default %default)')
+    parser.add_option('--delete-jobs', type='int',
+                      action='callback', callback=parse_workers,
+                      default=_DEFAULT_DELETE_JOBS,
+                      help='number of batches of objects to delete at ' +
+                      'once (default %default)')
+
+    parser.add_option('--manifest-version', type='choice',
+                      choices=['1', '2'], default='2',
+                      help='manifest format to write, 1 is readable by ' +
+                      'older versions [default: %default]')
+    parser.add_option('--layout', type='choice',
+                      choices=['positional', 'content'], default='positional',
+                      help='name blocks by position and content ' +
+                      '(positional), or by content alone so identical ' +
+                      'blocks are stored once (content) ' +
+                      '(default %default)')
+    parser.add_option('--hash', default=_DEFAULT_HASH,
+                      help='hashlib algorithm naming blocks in new ' +
+                      'backups, like sha256 or blake2b (default %default)')
+    parser.add_option('--tree-hash', action='store_true',
+                      help='hash pieces of each block in parallel, and ' +
+                      'then hash those together')
+    parser.add_option('--hash-jobs', type='int',
+                      action='callback', callback=parse_workers,
+                      default=_DEFAULT_HASH_JOBS,
+                      help='number of threads hashing the pieces of each ' +
+                      'block with --tree-hash (default %default)')
+    parser.add_option('--codec', default='gzip',
+                      help='compress blocks with [auto:]CODEC[:LEVEL], ' +
+                      'where CODEC is one of ' +
+                      ', '.join(_CODEC_FACTORIES.keys()) + '.  auto ' +
+                      'stores blocks which do not compress well as they ' +
+                      'are, and alone picks the fastest codec installed ' +
+                      '(default %default)')
+    parser.add_option('--chunking', type='choice', choices=['fixed', 'cdc'],
+                      default='fixed',
+                      help='split the device into fixed size blocks, or ' +
+                      'content defined chunks so that inserted data only ' +
+                      'changes nearby chunks (implies --layout content) ' +
+                      '(default %default)')
+    parser.add_option('--chunk-sizes', default=_DEFAULT_CHUNK_SIZES,
+                      help='MIN:AVG:MAX sizes of content defined chunks ' +
+                      '(default %default)')
+    parser.add_option('--pool', help='store content addressed blocks ' +
+                      'under this prefix, to share them between devices ' +
+                      '(default is the prefix)')
+    parser.add_option('--state-dir', default='~/.s3bdbk',
+                      help='directory for local state (default %default)')
+    parser.add_option('--reindex', action='store_true',
+                      help='rebuild the local index of stored blocks, ' +
+                      'if blocks may have been removed by another host')
+
     parser.add_option('--access', help='S3 Access Key')
     parser.add_option('--secret', help='S3 Secret Key')
     parser.add_option('--bucket', help='S3 Bucket')
     parser.add_option('--prefix', help='prefix in S3 bucket')
+    parser.add_option('--endpoint',
+                      help='URL of an S3 compatible service to use ' +
+                      'instead of S3, like http://localhost:9000')
+    parser.add_option('--connections', type='int',
+                      default=_DEFAULT_CONNECTIONS,
+                      help='most connections to S3 open at once ' +
+                      '(default %default)')
 
     cmd_group = optparse.OptionGroup(parser, "Sub-commands")
     cmd_group.add_option('--backup', action='append_const',
@@ -523,14 +3919,30 @@ def main():
     cmd_group.add_option('--restore', action='append_const',
                          const=do_restore, dest='func',
                          help='restore block device from remote storage')
+    cmd_group.add_option('--scrub', action='append_const',
+                         const=do_scrub, dest='func',
+                         help='check stored blocks against their hashes ' +
+                         'without restoring')
     cmd_group.add_option('--list', action='append_const',
                          const=do_list, dest='func',
                          help='list existing backups')
+    cmd_group.add_option('--extract-range', type='string',
+                         action='callback', callback=parse_extract_range,
+                         metavar='OFFSET:LEN',
+                         help='write LEN bytes of the backup from OFFSET ' +
+                         'to the -b file, or standard output')
+    cmd_group.add_option('--job-file', type='string', action='callback',
+                         callback=parse_job_file, metavar='FILE',
+                         help='back up every device listed in FILE at ' +
+                         'once, sharing workers between them')
     cmd_group.add_option('--version', action='append_const',
                          const=do_version, dest='func',
                          help='display version information')
     parser.add_option_group(cmd_group)
+    return parser
 
+def main():
+    parser = make_parser()
     (args, extra) = parser.parse_args()
 
     if args.func is None:
@@ -546,8 +3958,11 @@ def main():
         return 1
 
     result = args.func[0](args)
-    
-    if args.verbose:
+
+    # Nothing may follow data written to standard output.
+    to_stdout = args.restore_to == '-' or (
+        args.func[0] is do_extract and args.block is None)
+    if args.verbose and not to_stdout:
         sys.stdout.write(' ' * 75 + '\r')
         sys.stdout.flush()
     return result
@@ -2,11 +2,29 @@
 
 # Copyright 2013 Josh Pieper, jjp@pobox.com
 
+import cStringIO
 import datetime
+import errno
+import glob
+import hashlib
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
 import unittest
 
+import bench
 import s3bdbk
 
+try:
+    import boto
+    import moto
+except ImportError:
+    boto = None
+
 class TestCase(unittest.TestCase):
     def setUp(self):
         pass
@@ -78,6 +96,1154 @@ class TestCase(unittest.TestCase):
                 
         #print '\n'.join(manifests)
 
+    def test_retention_plan(self):
+        manifests = []
+        current = datetime.datetime(2013, 1, 1, 6, 0, 0)
+        for i in range(200):
+            manifests.append('manifest-%s-stuff' % current.strftime(
+                    '%Y%m%d-%H%M%S'))
+            current += datetime.timedelta(1)
+
+        # The choice of which to remove is random, so fix it.
+        random.seed(0)
+        removed = s3bdbk.RetentionPlanner(manifests).plan(25)
+        self.assertEqual(len(set(removed)), 175)
+        kept = sorted(set(manifests) - set(removed))
+        self.assertEqual(kept[0], manifests[0])
+        self.assertEqual(kept[-1], manifests[-1])
+
+        # Older backups are thinned out more.
+        dates = [s3bdbk.date_from_manifest(x) for x in kept]
+        gaps = [(b - a).days for a, b in zip(dates, dates[1:])]
+        self.assertTrue(sum(gaps[:12]) > sum(gaps[-12:]))
+
+    def test_retention_plan_same_second(self):
+        # Backups with no time between them go first, rather than
+        # leaving nothing to choose from.
+        manifests = ['manifest-20130101-060000-%08d' % x for x in range(4)]
+        manifests.append('manifest-20130102-060000-00000000')
+        self.assertEqual(s3bdbk.RetentionPlanner(manifests).plan(3),
+                         manifests[1:3])
+        self.assertEqual(s3bdbk.RetentionPlanner(manifests[:2]).plan(1), [])
+
+
+class BackupTestCase(unittest.TestCase):
+    '''Exercises backup and restore against a DirectoryStorage, using a
+    small block size so that the test devices stay small.'''
+
+    def setUp(self):
+        self.old_block_size = s3bdbk._BLOCK_SIZE
+        self.old_chunk_size = s3bdbk._CHUNK_SIZE
+        s3bdbk._BLOCK_SIZE = 4096
+        # Not a divisor of the block size, so that streams are split
+        # unevenly.
+        s3bdbk._CHUNK_SIZE = 1000
+        self.tempdir = tempfile.mkdtemp()
+        self.store = os.path.join(self.tempdir, 'store')
+        os.mkdir(self.store)
+
+    def tearDown(self):
+        s3bdbk._BLOCK_SIZE = self.old_block_size
+        s3bdbk._CHUNK_SIZE = self.old_chunk_size
+        shutil.rmtree(self.tempdir)
+
+    def make_device(self, name, num_blocks, seed=0, period=64):
+        rng = random.Random(seed)
+        path = os.path.join(self.tempdir, name)
+        f = open(path, 'wb')
+        for i in range(num_blocks):
+            # Repeat a little randomness so the blocks compress.
+            f.write(''.join(chr(rng.randint(0, 255))
+                            for x in range(period)) * (4096 / period))
+        f.close()
+        return path
+
+    def parse_args(self, *argv, **kwargs):
+        prefix = kwargs.get('prefix', 'dev')
+        args, extra = s3bdbk.make_parser().parse_args(
+            list(argv) + ['-d', os.path.join(self.store, prefix),
+                          '--state-dir', os.path.join(self.tempdir, 'state')])
+        return args
+
+    def run_command(self, *argv, **kwargs):
+        args = self.parse_args(*argv, **kwargs)
+        old_stdout = sys.stdout
+        sys.stdout = cStringIO.StringIO()
+        try:
+            return args.func[0](args)
+        finally:
+            sys.stdout = old_stdout
+
+    def load_manifest(self, prefix='dev'):
+        storage = s3bdbk.make_storage(self.parse_args(prefix=prefix))
+        return s3bdbk.parse_manifest(
+            storage.load(storage.load(s3bdbk.get_current_name(storage)))).items
+
+    def test_backup_restore(self):
+        device = self.make_device('device', 10)
+        self.assertEqual(self.run_command('--backup', '-b', device), 0)
+
+        restored = os.path.join(self.tempdir, 'restored')
+        self.run_command('--restore', '-b', restored)
+        self.assertEqual(open(restored, 'rb').read(),
+                         open(device, 'rb').read())
+
+    def test_direct_io(self):
+        device = self.make_device('device', 10)
+        data = open(device, 'rb').read()
+        source = s3bdbk.PositionalFile(device, direct=True)
+        buf = source.buffers.acquire()
+        # Neither end of the region is on an alignment boundary, and
+        # no more is read than fits in the buffer.
+        self.assertEqual(str(source.read_into(5000, 9000, buf)),
+                         data[5000:6000])
+        reader = s3bdbk.RegionReader(source, 4095, 4096 * 10)
+        self.assertEqual(''.join(str(x) for x in iter(
+                    lambda: reader.read(3000), '')), data[4095:])
+        source.close()
+
+        fadvise = s3bdbk.get_posix_fadvise()
+        if fadvise is not None:
+            f = open(device, 'rb')
+            self.assertEqual(fadvise(f.fileno(), 4096, 1 << 40,
+                                     s3bdbk._POSIX_FADV_DONTNEED), 0)
+            self.assertEqual(fadvise(f.fileno(), 0, 4096, 1000),
+                             errno.EINVAL)
+            f.close()
+
+        self.assertEqual(self.run_command('--backup', '-b', device,
+                                          '--direct-io'), 0)
+        restored = os.path.join(self.tempdir, 'restored')
+        shutil.copy(self.make_device('other', 10, seed=1), restored)
+        f = open(restored, 'r+b')
+        f.write(data[:4096 * 5])
+        f.close()
+        self.assertEqual(self.run_command('--restore', '-b', restored,
+                                          '--direct-io'), 0)
+        self.assertEqual(open(restored, 'rb').read(), data)
+
+    def test_parallel_backup_matches_serial(self):
+        device = self.make_device('device', 25)
+        self.run_command('--backup', '-b', device, '-j', '1',
+                         '--upload-jobs', '1')
+        serial_items = [x.name for x in self.load_manifest()]
+        serial_files = sorted(os.listdir(self.store))
+
+        shutil.rmtree(self.store)
+        os.mkdir(self.store)
+        self.run_command('--backup', '-b', device, '-j', '4',
+                         '--upload-jobs', '3', '--reindex')
+        self.assertEqual([x.name for x in self.load_manifest()], serial_items)
+        self.assertEqual(
+            [x for x in sorted(os.listdir(self.store)) if '-data-' in x],
+            [x for x in serial_files if '-data-' in x])
+
+    def test_parallel_restore_over_existing(self):
+        device = self.make_device('device', 20)
+        self.run_command('--backup', '-b', device)
+
+        # Start from a target which differs in only some places.
+        restored = os.path.join(self.tempdir, 'restored')
+        shutil.copy(self.make_device('other', 20, seed=1), restored)
+        f = open(restored, 'r+b')
+        f.write(open(device, 'rb').read(4096 * 10))
+        f.close()
+
+        self.assertEqual(self.run_command(
+                '--restore', '-b', restored, '-j', '3', '--prefetch', '5'), 0)
+        self.assertEqual(open(restored, 'rb').read(),
+                         open(device, 'rb').read())
+
+    def test_restore_checksum_error(self):
+        device = self.make_device('device', 4)
+        self.run_command('--backup', '-b', device)
+
+        item = self.load_manifest()[2].name
+        f = open(os.path.join(self.store, item), 'wb')
+        f.write(s3bdbk.compress_block('x' * 4096))
+        f.close()
+
+        old_stderr = sys.stderr
+        sys.stderr = cStringIO.StringIO()
+        try:
+            result = self.run_command(
+                '--restore', '-b', os.path.join(self.tempdir, 'restored'))
+            message = sys.stderr.getvalue()
+        finally:
+            sys.stderr = old_stderr
+        self.assertEqual(result, 1)
+        self.assertTrue('Checksum error' in message)
+        # None of the bad block was written.
+        self.assertFalse('x' * 1000 in open(
+                os.path.join(self.tempdir, 'restored'), 'rb').read())
+
+    def test_restore_missing_block(self):
+        device = self.make_device('device', 4)
+        self.run_command('--backup', '-b', device)
+        missing = self.load_manifest()[2].name
+        os.remove(os.path.join(self.store, missing))
+
+        # Nothing is written when a block is missing.
+        restored = os.path.join(self.tempdir, 'restored')
+        self.assertEqual(self.run_command('--restore', '-b', restored), 1)
+        self.assertFalse(os.path.exists(restored))
+
+        # Storage which cannot list is asked about each block instead.
+        class Unlisted(object):
+            def __init__(self, storage):
+                self.exists = storage.exists
+        storage = s3bdbk.make_storage(self.parse_args())
+        names = set(x.name for x in self.load_manifest())
+        for target in [storage, Unlisted(storage)]:
+            self.assertEqual(
+                s3bdbk.find_missing(target, names, 2)[0], set([missing]))
+
+    def test_resume_backup(self):
+        device = self.make_device('device', 8)
+        stored = []
+        old_store_stream = s3bdbk.DirectoryStorage.store_stream
+        def store_stream(storage, name, stream, progress_function=None):
+            if len(stored) == 5:
+                raise IOError('interrupted')
+            stored.append(name)
+            return old_store_stream(storage, name, stream)
+        s3bdbk.DirectoryStorage.store_stream = store_stream
+        try:
+            self.assertRaises(IOError, self.run_command,
+                              '--backup', '-b', device, '-j', '1',
+                              '--upload-jobs', '1')
+            storage = s3bdbk.make_storage(self.parse_args())
+            self.assertEqual(storage.list('dev-manifest-'), [])
+            self.assertFalse(storage.exists('dev-current'))
+
+            # Resuming stores only what was not stored before.
+            del stored[:]
+            self.assertEqual(self.run_command(
+                    '--backup', '-b', device, '--resume'), 0)
+            self.assertEqual(len(stored), 3)
+        finally:
+            s3bdbk.DirectoryStorage.store_stream = old_store_stream
+
+        self.assertTrue(all(x.new for x in self.load_manifest()))
+        self.assertFalse(glob.glob(
+                os.path.join(self.tempdir, 'state', '*.journal')))
+        restored = os.path.join(self.tempdir, 'restored')
+        self.assertEqual(self.run_command('--restore', '-b', restored), 0)
+        self.assertEqual(open(restored, 'rb').read(),
+                         open(device, 'rb').read())
+
+        # A block found missing at the end is not counted as done, so
+        # resuming stores it again.
+        missing = self.load_manifest()[4].name
+        os.remove(os.path.join(self.store, missing))
+        self.assertRaises(s3bdbk.BackupError, self.run_command,
+                          '--backup', '-b', device)
+        self.assertEqual(self.run_command(
+                '--backup', '-b', device, '--resume'), 0)
+        self.assertTrue(os.path.exists(os.path.join(self.store, missing)))
+        os.remove(restored)
+        self.assertEqual(self.run_command('--restore', '-b', restored), 0)
+        self.assertEqual(open(restored, 'rb').read(),
+                         open(device, 'rb').read())
+
+    def test_base_manifest_restore(self):
+        device = self.make_device('device', 6)
+        self.run_command('--backup', '-b', device)
+        storage = s3bdbk.make_storage(self.parse_args())
+        base = storage.load('dev-current')
+        restored = os.path.join(self.tempdir, 'restored')
+        self.assertEqual(self.run_command('--restore', '-b', restored), 0)
+
+        f = open(device, 'r+b')
+        f.seek(4096 * 3)
+        f.write('x' * 4096)
+        f.close()
+        self.run_command('--backup', '-b', device)
+
+        # A block the base manifest says is already there is neither
+        # read nor written, so damage to it goes unnoticed.
+        f = open(restored, 'r+b')
+        f.write('y')
+        f.close()
+
+        loads = []
+        old_load_stream = s3bdbk.DirectoryStorage.load_stream
+        def load_stream(storage, name):
+            loads.append(name)
+            return old_load_stream(storage, name)
+        s3bdbk.DirectoryStorage.load_stream = load_stream
+        try:
+            self.assertEqual(self.run_command(
+                    '--restore', '-b', restored, '--base-manifest', base), 0)
+            self.assertEqual(len(loads), 1)
+            self.assertEqual(open(restored, 'rb').read()[1:],
+                             open(device, 'rb').read()[1:])
+            self.assertNotEqual(open(restored, 'rb').read(),
+                                open(device, 'rb').read())
+
+            self.assertEqual(self.run_command(
+                    '--restore', '-b', restored, '--base-manifest', 'last',
+                    '--verify'), 0)
+            self.assertEqual(len(loads), 2)
+            self.assertEqual(open(restored, 'rb').read(),
+                             open(device, 'rb').read())
+
+            # The last restore is remembered.
+            self.assertEqual(self.run_command(
+                    '--restore', '-b', restored, '--base-manifest', 'last'), 0)
+            self.assertEqual(len(loads), 2)
+        finally:
+            s3bdbk.DirectoryStorage.load_stream = old_load_stream
+
+    def test_backup_reader(self):
+        device = self.make_device('device', 8)
+        f = open(device, 'r+b')
+        f.seek(4096 * 2)
+        f.write('\0' * 4096)
+        f.truncate(4096 * 7 + 10)
+        f.close()
+        data = open(device, 'rb').read()
+        self.run_command('--backup', '-b', device)
+
+        storage = s3bdbk.make_storage(self.parse_args())
+        manifest = s3bdbk.parse_manifest(
+            storage.load(storage.load('dev-current')))
+        loads = []
+        old_load_stream = s3bdbk.DirectoryStorage.load_stream
+        def load_stream(storage, name):
+            loads.append(name)
+            return old_load_stream(storage, name)
+        s3bdbk.DirectoryStorage.load_stream = load_stream
+        try:
+            reader = s3bdbk.BackupReader(storage, manifest, cache_size=8192,
+                                         prefetch=0)
+            self.assertEqual(reader.read(5000, 100), data[5000:5100])
+            self.assertEqual(reader.read(4000, 5000), data[4000:9000])
+            self.assertEqual(len(loads), 2)
+            self.assertEqual(reader.read(4096 * 7, 100), data[4096 * 7:])
+
+            # Only two whole blocks fit in the cache, so the least
+            # recently used is gone.
+            self.assertEqual(reader.read(4096, 100), data[4096:4196])
+            self.assertEqual(len(loads), 3)
+            self.assertEqual(reader.read(0, 100), data[:100])
+            self.assertEqual(len(loads), 4)
+            reader.close()
+
+            # Sequential reads fetch ahead.
+            del loads[:]
+            reader = s3bdbk.BackupReader(storage, manifest, prefetch=4)
+            for offset in range(0, len(data), 1000):
+                self.assertEqual(reader.read(offset, 1000),
+                                 data[offset:offset + 1000])
+            reader.close()
+            self.assertEqual(sorted(loads), sorted(
+                    set(x.name for x in manifest.items
+                        if x.name != s3bdbk._ZERO_BLOCK_NAME)))
+        finally:
+            s3bdbk.DirectoryStorage.load_stream = old_load_stream
+
+        extracted = os.path.join(self.tempdir, 'extracted')
+        self.assertEqual(self.run_command(
+                '--extract-range', '6000:2K', '-b', extracted), 0)
+        self.assertEqual(open(extracted, 'rb').read(), data[6000:8048])
+
+        # Written to standard output, the range is all there is, even
+        # with -v.
+        old_argv, old_stdout = sys.argv, sys.stdout
+        sys.argv = ['s3bdbk', '--extract-range', '6000:2K', '-v',
+                    '-d', os.path.join(self.store, 'dev'),
+                    '--state-dir', os.path.join(self.tempdir, 'state')]
+        sys.stdout = output = cStringIO.StringIO()
+        try:
+            self.assertEqual(s3bdbk.main(), 0)
+        finally:
+            sys.argv, sys.stdout = old_argv, old_stdout
+        self.assertEqual(output.getvalue(), data[6000:8048])
+
+    def test_restore_to_stdout(self):
+        device = self.make_device('device', 6)
+        f = open(device, 'r+b')
+        f.seek(4096 * 2)
+        f.write('\0' * 4096)
+        f.truncate(4096 * 5 + 10)
+        f.close()
+        self.run_command('--backup', '-b', device)
+
+        args = self.parse_args('--restore', '--restore-to', '-', '-v',
+                               '--prefetch', '2')
+        old_stdout, old_stderr = sys.stdout, sys.stderr
+        sys.stdout = output = cStringIO.StringIO()
+        sys.stderr = messages = cStringIO.StringIO()
+        try:
+            self.assertEqual(s3bdbk.do_restore(args), 0)
+        finally:
+            sys.stdout, sys.stderr = old_stdout, old_stderr
+        self.assertEqual(output.getvalue(), open(device, 'rb').read())
+        self.assertTrue('Restoring from' in messages.getvalue())
+
+    def test_block_index(self):
+        device = self.make_device('device', 6)
+        self.run_command('--backup', '-b', device)
+
+        # With the index in place, a second backup never asks the
+        # storage whether blocks exist.
+        exists_calls = []
+        old_exists = s3bdbk.DirectoryStorage.exists
+        def exists(storage, name):
+            exists_calls.append(name)
+            return old_exists(storage, name)
+        s3bdbk.DirectoryStorage.exists = exists
+        try:
+            self.run_command('--backup', '-b', device)
+        finally:
+            s3bdbk.DirectoryStorage.exists = old_exists
+        self.assertEqual(exists_calls, [])
+
+        # A block removed behind the index's back is found missing
+        # before a manifest names it, and dropped from the index, so
+        # the next backup stores it again.
+        manifest = self.load_manifest()
+        item = manifest[3].name
+        os.remove(os.path.join(self.store, item))
+        self.assertRaises(s3bdbk.BackupError, self.run_command,
+                          '--backup', '-b', device)
+        self.assertEqual([x.name for x in self.load_manifest()],
+                         [x.name for x in manifest])
+        self.run_command('--backup', '-b', device)
+        self.assertTrue(os.path.exists(os.path.join(self.store, item)))
+        restored = os.path.join(self.tempdir, 'restored')
+        self.assertEqual(self.run_command('--restore', '-b', restored), 0)
+        self.assertEqual(open(restored, 'rb').read(),
+                         open(device, 'rb').read())
+
+    def data_files(self):
+        return sorted(x for x in os.listdir(self.store) if '-data-' in x)
+
+    def test_content_layout(self):
+        # A device where every block appears twice.
+        blocks = open(self.make_device('blocks', 4), 'rb').read()
+        device = os.path.join(self.tempdir, 'device')
+        open(device, 'wb').write(blocks + blocks)
+        self.run_command('--backup', '-b', device, '--layout', 'content')
+        self.assertEqual(len(self.data_files()), 4)
+
+        restored = os.path.join(self.tempdir, 'restored')
+        self.assertEqual(self.run_command('--restore', '-b', restored), 0)
+        self.assertEqual(open(restored, 'rb').read(),
+                         open(device, 'rb').read())
+
+    def test_shared_pool(self):
+        device1 = self.make_device('device1', 6)
+        device2 = os.path.join(self.tempdir, 'device2')
+        shutil.copy(device1, device2)
+        f = open(device2, 'r+b')
+        f.seek(4096 * 2)
+        f.write('x' * 4096)
+        f.close()
+
+        for prefix, device in [('dev1', device1), ('dev2', device2)]:
+            self.run_command('--backup', '-b', device, '--layout', 'content',
+                             '--pool', 'shared', prefix=prefix)
+        self.assertEqual(len(self.data_files()), 7)
+
+        # Once the first device's backup is gone, cleaning up after it
+        # removes only the block no other device uses.
+        for name in os.listdir(self.store):
+            if name.startswith('dev1-manifest-'):
+                os.remove(os.path.join(self.store, name))
+        self.run_command('--list', '--cleanup', '--pool', 'shared',
+                         prefix='dev1')
+        self.assertEqual(len(self.data_files()), 6)
+
+        restored = os.path.join(self.tempdir, 'restored')
+        self.assertEqual(self.run_command(
+                '--restore', '-b', restored, prefix='dev2'), 0)
+        self.assertEqual(open(restored, 'rb').read(),
+                         open(device2, 'rb').read())
+
+    def test_cleanup_ref_counts(self):
+        loads = []
+        old_load = s3bdbk.DirectoryStorage.load
+        def load(storage, name):
+            loads.append(name)
+            return old_load(storage, name)
+        s3bdbk.DirectoryStorage.load = load
+        # Backups an hour apart, so that the limit can choose between
+        # them.
+        old_create_manifest_name = s3bdbk.create_manifest_name
+        manifest_names = iter('dev-manifest-20150101-%02d0000-00000000' % x
+                              for x in range(3))
+        s3bdbk.create_manifest_name = lambda storage: next(manifest_names)
+        try:
+            for seed in range(3):
+                device = self.make_device('device', 4, seed=seed)
+                self.run_command('--backup', '-b', device,
+                                 '--limit', '2', '--cleanup')
+        finally:
+            s3bdbk.DirectoryStorage.load = old_load
+            s3bdbk.create_manifest_name = old_create_manifest_name
+
+        # Every manifest was counted as it was written, so none were
+        # read back, and only the blocks of the remaining two are kept.
+        self.assertFalse([x for x in loads if '-manifest-' in x])
+        storage = s3bdbk.make_storage(self.parse_args())
+        required = set()
+        for name in storage.list('dev-manifest-'):
+            required.update(x.name for x in
+                            s3bdbk.parse_manifest(storage.load(name)).items)
+        self.assertEqual(len(required), 8)
+        self.assertEqual(set(self.data_files()), required)
+
+        # Losing the local state only means counting afresh.
+        shutil.rmtree(os.path.join(self.tempdir, 'state'))
+        for name in storage.list('dev-manifest-')[:1]:
+            os.remove(os.path.join(self.store, name))
+        self.run_command('--list', '--cleanup')
+        self.assertEqual(len(self.data_files()), 4)
+
+    def test_cleanup_dry_run(self):
+        old_create_manifest_name = s3bdbk.create_manifest_name
+        manifest_names = iter('dev-manifest-20150101-%02d0000-00000000' % x
+                              for x in range(3))
+        s3bdbk.create_manifest_name = lambda storage: next(manifest_names)
+        old_stdout = sys.stdout
+        try:
+            for seed in range(2):
+                self.run_command('--backup', '-b',
+                                 self.make_device('device', 4, seed=seed))
+            args = self.parse_args('--backup', '-b',
+                                   self.make_device('device', 4, seed=2),
+                                   '--limit', '2', '--cleanup', '--dry-run')
+            sys.stdout = output = cStringIO.StringIO()
+            s3bdbk.do_backup(args)
+        finally:
+            sys.stdout = old_stdout
+            s3bdbk.create_manifest_name = old_create_manifest_name
+
+        # The middle backup would go, along with its four blocks.
+        storage = s3bdbk.make_storage(self.parse_args())
+        reclaimed = sum(x.stored_size for x in s3bdbk.parse_manifest(
+                storage.load('dev-manifest-20150101-010000-00000000')).items)
+        self.assertTrue('Would prune 4 unused data files, reclaiming %d bytes'
+                        % reclaimed in output.getvalue())
+        self.assertEqual(len(storage.list('dev-manifest-')), 3)
+        self.assertEqual(len(self.data_files()), 12)
+
+        self.run_command('--list', '--cleanup')
+        self.assertEqual(len(self.data_files()), 12)
+
+    def test_remove_many(self):
+        storage = s3bdbk.make_storage(self.parse_args())
+        for name in ['dev-data-1', 'dev-data-2']:
+            storage.store(name, 'data')
+        os.mkdir(os.path.join(self.store, 'dev-data-3'))
+        errors = storage.remove_many(
+            ['dev-data-1', 'dev-data-2', 'dev-data-3', 'dev-data-4'])
+        self.assertEqual(errors.keys(), ['dev-data-3'])
+        self.assertEqual(storage.list('dev-data-'), ['dev-data-3'])
+
+    def test_chunker_scans(self):
+        data = open(self.make_device('device', 64), 'rb').read()
+        chunker = s3bdbk.Chunker(2000, 8000, 20000)
+        whole = chunker.candidates(data, 0)
+        self.assertTrue(len(whole) > 0)
+
+        # Candidates do not depend on how the data is split into scans,
+        # or on whether numpy is available.
+        old_scan_size = s3bdbk._CDC_SCAN_SIZE
+        s3bdbk._CDC_SCAN_SIZE = 777
+        try:
+            source = s3bdbk.PositionalFile(os.path.join(self.tempdir,
+                                                        'device'))
+            chunks = list(chunker.chunks(source, len(data)))
+            source.close()
+        finally:
+            s3bdbk._CDC_SCAN_SIZE = old_scan_size
+
+        self.assertEqual(sum(length for offset, length, x in chunks),
+                         len(data))
+        for offset, length, pieces in chunks[:-1]:
+            self.assertTrue(2000 <= length <= 20000)
+            self.assertTrue(length == 20000 or offset + length in whole)
+        # Each chunk comes with the data scanned to find it.
+        for offset, length, pieces in chunks:
+            self.assertEqual(''.join(str(x) for x in pieces),
+                             data[offset:offset + length])
+
+        chunker._numpy = None
+        self.assertEqual(chunker.candidates(data, 0), whole)
+
+        # Without numpy, there is a warning that chunking will be slow.
+        old_numpy, old_stderr = sys.modules.get('numpy'), sys.stderr
+        sys.modules['numpy'] = None
+        sys.stderr = messages = cStringIO.StringIO()
+        try:
+            s3bdbk.Chunker(2000, 8000, 20000)
+        finally:
+            sys.modules['numpy'], sys.stderr = old_numpy, old_stderr
+        self.assertTrue('numpy' in messages.getvalue())
+
+    def test_cdc_backup(self):
+        # Chunk boundaries in periodic data would be periodic too, so
+        # this device is entirely random.
+        device = self.make_device('device', 64, period=4096)
+        stats_file = os.path.join(self.tempdir, 'stats.json')
+        self.run_command('--backup', '-b', device, '--chunking', 'cdc',
+                         '--chunk-sizes', '2K:8K:20K',
+                         '--stats-file', stats_file)
+        before = set(self.data_files())
+        # The device is read once, to find the chunks and store them.
+        stages = json.load(open(stats_file))['stages']
+        self.assertEqual(stages['read']['bytes'], 64 * 4096)
+
+        # Insert some data near the start, which shifts everything
+        # after it.
+        data = open(device, 'rb').read()
+        open(device, 'wb').write(data[:5000] + 'inserted' + data[5000:])
+        self.run_command('--backup', '-b', device, '--chunking', 'cdc',
+                         '--chunk-sizes', '2K:8K:20K')
+        added = set(self.data_files()) - before
+        self.assertTrue(len(added) <= 3)
+
+        restored = os.path.join(self.tempdir, 'restored')
+        self.assertEqual(self.run_command('--restore', '-b', restored), 0)
+        self.assertEqual(open(restored, 'rb').read(),
+                         open(device, 'rb').read())
+
+    def test_codecs(self):
+        data = open(self.make_device('device', 5), 'rb').read()
+        for name in s3bdbk._CODEC_FACTORIES:
+            try:
+                codec = s3bdbk.get_codec(name)
+            except ImportError:
+                continue
+            compressed = s3bdbk.compress_block(data, name)
+            self.assertEqual(s3bdbk.decompress_block(compressed, name), data)
+
+            device = os.path.join(self.tempdir, 'device')
+            self.run_command('--backup', '-b', device, '--codec', name)
+            item = self.load_manifest()[0].name
+            self.assertEqual(s3bdbk.get_block_codec(item).name, name)
+            restored = os.path.join(self.tempdir, 'restored-' + name)
+            self.assertEqual(self.run_command('--restore', '-b', restored), 0)
+            self.assertEqual(open(restored, 'rb').read(), data)
+
+    def test_auto_codec(self):
+        device = self.make_device('device', 2)
+        f = open(device, 'ab')
+        f.write(os.urandom(4096))
+        f.close()
+        self.run_command('--backup', '-b', device, '--codec', 'auto:gzip:6')
+        self.assertEqual([s3bdbk.get_block_codec(x.name).name
+                          for x in self.load_manifest()],
+                         ['gzip', 'gzip', 'none'])
+
+    def test_zero_blocks(self):
+        device = self.make_device('device', 3)
+        f = open(device, 'r+b')
+        # A written zero block, and a hole at the end.
+        f.seek(4096)
+        f.write('\0' * 4096)
+        f.truncate(4096 * 6)
+        f.close()
+
+        self.run_command('--backup', '-b', device)
+        names = [x.name for x in self.load_manifest()]
+        self.assertEqual(names[1], s3bdbk._ZERO_BLOCK_NAME)
+        self.assertEqual(names[3:], [s3bdbk._ZERO_BLOCK_NAME] * 3)
+        self.assertEqual(len(self.data_files()), 2)
+
+        # Restoring onto something else must still clear the zero
+        # regions, and a new file must still reach its full size.
+        for start in [None, 'other']:
+            restored = os.path.join(self.tempdir, 'restored')
+            if start is not None:
+                shutil.copy(self.make_device(start, 6, seed=1), restored)
+            elif os.path.exists(restored):
+                os.remove(restored)
+            self.assertEqual(self.run_command('--restore', '-b', restored), 0)
+            self.assertEqual(open(restored, 'rb').read(),
+                             open(device, 'rb').read())
+
+    def test_manifest_v2(self):
+        device = self.make_device('device', 4)
+        f = open(device, 'r+b')
+        f.seek(4096)
+        f.write('\0' * 4096)
+        f.truncate(4096 * 3 + 100)
+        f.close()
+
+        self.run_command('--backup', '-b', device)
+        items = self.load_manifest()
+        self.assertEqual([x.length for x in items], [4096] * 3 + [100])
+        self.assertEqual(items[1].name, s3bdbk._ZERO_BLOCK_NAME)
+        self.assertEqual([x.new for x in items], [True, False, True, True])
+        sizes = dict((x, os.path.getsize(os.path.join(self.store, x)))
+                     for x in self.data_files())
+        for item in items[0:1] + items[2:]:
+            self.assertEqual(item.stored_size, sizes[item.name])
+
+        # A second backup stores nothing new, but still knows the sizes.
+        self.run_command('--backup', '-b', device)
+        again = self.load_manifest()
+        self.assertEqual([x.name for x in again], [x.name for x in items])
+        self.assertFalse(any(x.new for x in again))
+        self.assertEqual([x.stored_size for x in again],
+                         [x.stored_size for x in items])
+
+        restored = os.path.join(self.tempdir, 'restored')
+        self.assertEqual(self.run_command('--restore', '-b', restored), 0)
+        self.assertEqual(open(restored, 'rb').read(),
+                         open(device, 'rb').read())
+
+    def test_manifest_v1(self):
+        device = self.make_device('device', 3)
+        self.run_command('--backup', '-b', device, '--manifest-version', '1')
+        storage = s3bdbk.make_storage(self.parse_args())
+        manifest = storage.load(storage.load(s3bdbk.get_current_name(storage)))
+        self.assertTrue(manifest.startswith('Version: 1.0\n'))
+
+        # Version 2 backups and restores work alongside it.
+        self.run_command('--backup', '-b', device, '--layout', 'content',
+                         '--cleanup')
+        restored = os.path.join(self.tempdir, 'restored')
+        for manifest_name in sorted(storage.list('dev-manifest-')):
+            if os.path.exists(restored):
+                os.remove(restored)
+            self.assertEqual(self.run_command(
+                    '--restore', '-b', restored, '--manifest', manifest_name), 0)
+            self.assertEqual(open(restored, 'rb').read(),
+                             open(device, 'rb').read())
+
+        # A short last block can only be described by version 1.1.
+        short = self.make_device('short', 3)
+        f = open(short, 'r+b')
+        f.truncate(4096 * 2 + 1000)
+        f.close()
+        self.run_command('--backup', '-b', short, '--manifest-version', '1')
+        manifest = storage.load(storage.load(s3bdbk.get_current_name(storage)))
+        self.assertTrue(manifest.startswith('Version: 1.1\n'))
+        self.assertTrue(manifest.endswith(' 1000\n'))
+        os.remove(restored)
+        self.assertEqual(self.run_command('--restore', '-b', restored), 0)
+        self.assertEqual(open(restored, 'rb').read(), open(short, 'rb').read())
+
+    def test_hash_selection(self):
+        s3bdbk._TREE_LEAF_SIZE = 1000
+        try:
+            device = self.make_device('device', 4)
+            for argv in [['--hash', 'sha256'],
+                         ['--hash', 'sha1', '--tree-hash', '--hash-jobs', '3']]:
+                shutil.rmtree(self.store)
+                os.mkdir(self.store)
+                self.run_command('--backup', '-b', device, '--reindex', *argv)
+                storage = s3bdbk.make_storage(self.parse_args())
+                manifest = s3bdbk.parse_manifest(
+                    storage.load(storage.load('dev-current')))
+                self.assertEqual(manifest.headers['Hash'], argv[1])
+
+                restored = os.path.join(self.tempdir, 'restored')
+                self.assertEqual(self.run_command(
+                        '--restore', '-b', restored), 0)
+                self.assertEqual(open(restored, 'rb').read(),
+                                 open(device, 'rb').read())
+        finally:
+            s3bdbk._TREE_LEAF_SIZE = 2**20
+
+        # The tree hash is the hash of the leaf hashes.
+        data = open(device, 'rb').read(4096)
+        self.assertEqual(manifest.headers['Hash-leaf-size'], '1000')
+        leaves = ''.join(hashlib.sha1(data[x:x + 1000]).digest()
+                         for x in range(0, 4096, 1000))
+        self.assertEqual(s3bdbk.parse_block_name(manifest.items[0].name)[1],
+                         hashlib.sha1(leaves).hexdigest())
+
+        # Hash functions share their worker threads.
+        threads = len(s3bdbk._hash_threads)
+        for x in range(5):
+            hasher = s3bdbk.HashFunction('sha1', 1000, 3)()
+            hasher.update(data)
+            self.assertEqual(hasher.hexdigest(),
+                             hashlib.sha1(leaves).hexdigest())
+        self.assertEqual(len(s3bdbk._hash_threads), threads)
+
+    def test_stats_file(self):
+        device = self.make_device('device', 4)
+        stats_file = os.path.join(self.tempdir, 'stats.json')
+        old_stderr = sys.stderr
+        sys.stderr = log = cStringIO.StringIO()
+        try:
+            self.run_command('--backup', '-b', device, '--stats-file',
+                             stats_file, '--stats-interval', '0')
+        finally:
+            sys.stderr = old_stderr
+
+        report = json.load(open(stats_file))
+        self.assertEqual(report['operation'], 'backup')
+        stages = report['stages']
+        for stage in ['read', 'hash', 'exists', 'compress', 'upload']:
+            self.assertTrue(stage in stages)
+        # Every block is read twice, once to hash and once to store.
+        self.assertEqual(stages['read']['bytes'], 2 * 4 * 4096)
+        self.assertEqual(stages['upload']['bytes'],
+                         sum(x.stored_size for x in self.load_manifest()))
+        self.assertEqual(sum(x['count'] for x in stages['upload']['histogram']),
+                         4)
+        lines = [json.loads(x) for x in log.getvalue().splitlines()]
+        self.assertTrue(lines)
+        self.assertTrue(all(x['operation'] == 'backup' for x in lines))
+
+        restored = os.path.join(self.tempdir, 'restored')
+        self.run_command('--restore', '-b', restored,
+                         '--stats-file', stats_file)
+        stages = json.load(open(stats_file))['stages']
+        self.assertEqual(stages['write']['bytes'], 4 * 4096)
+        self.assertEqual(stages['download']['count'], 4)
+
+        # Backing up the unchanged device again reads each block once,
+        # and neither stores nor spools any of them.
+        temp_files = []
+        old_mkstemp_inner = tempfile._mkstemp_inner
+        old_spooled = tempfile.SpooledTemporaryFile
+        def mkstemp_inner(*args):
+            temp_files.append(args)
+            return old_mkstemp_inner(*args)
+        def spooled(*args, **kwargs):
+            temp_files.append(args)
+            return old_spooled(*args, **kwargs)
+        tempfile._mkstemp_inner = mkstemp_inner
+        tempfile.SpooledTemporaryFile = spooled
+        try:
+            self.run_command('--backup', '-b', device,
+                             '--stats-file', stats_file)
+        finally:
+            tempfile._mkstemp_inner = old_mkstemp_inner
+            tempfile.SpooledTemporaryFile = old_spooled
+        stages = json.load(open(stats_file))['stages']
+        self.assertEqual(stages['read']['bytes'], 4 * 4096)
+        self.assertFalse('upload' in stages)
+        self.assertEqual(temp_files, [])
+
+    def test_stream_compression(self):
+        data = open(self.make_device('device', 5), 'rb').read()
+        compressed = s3bdbk.get_codec('gzip').compress(
+            cStringIO.StringIO(data))
+        pieces = [str(x) for x in iter(lambda: compressed.read(700), '')]
+        self.assertTrue(max(len(x) for x in pieces) <= 700)
+        self.assertEqual(s3bdbk.read_fully(s3bdbk.get_codec('gzip').compress(
+                    cStringIO.StringIO(data)), 10**6), ''.join(pieces))
+
+        # Without compression, what is read is passed on uncopied.
+        views = [buffer(data, x, 1000) for x in range(0, len(data), 1000)]
+        stored = s3bdbk.get_codec('none').compress(s3bdbk.PiecesReader(views))
+        for view in views:
+            self.assertTrue(stored.read(2000) is view)
+        self.assertEqual(stored.read(2000), '')
+
+        decompressed = s3bdbk.DecompressingReader(
+            cStringIO.StringIO(''.join(pieces)))
+        pieces = list(iter(lambda: decompressed.read(300), ''))
+        self.assertTrue(max(len(x) for x in pieces) <= 300)
+        self.assertEqual(''.join(pieces), data)
+
+    def test_directory_storage_streams(self):
+        storage = s3bdbk.make_storage(self.parse_args())
+        data = open(self.make_device('device', 3), 'rb').read()
+        storage.store_stream('dev-object', cStringIO.StringIO(data))
+        stream = storage.load_stream('dev-object')
+        self.assertEqual(stream.read(), data)
+        stream.close()
+
+    def test_manifest_synced_before_current(self):
+        events = []
+        old_store = s3bdbk.DirectoryStorage.store
+        old_sync = s3bdbk.DirectoryStorage.sync
+
+        def store(storage, name, data, progress_function=None):
+            events.append(name)
+            return old_store(storage, name, data, progress_function)
+
+        def sync(storage):
+            events.append('sync')
+            return old_sync(storage)
+
+        s3bdbk.DirectoryStorage.store = store
+        s3bdbk.DirectoryStorage.sync = sync
+        try:
+            self.run_command('--backup', '-b', self.make_device('device', 2))
+        finally:
+            s3bdbk.DirectoryStorage.store = old_store
+            s3bdbk.DirectoryStorage.sync = old_sync
+
+        manifest = [x for x in events if '-manifest-' in x][0]
+        self.assertEqual(events[events.index(manifest):],
+                         [manifest, 'sync', 'dev-current', 'sync'])
+
+    def test_sharded_directory(self):
+        device = self.make_device('device', 4)
+        self.run_command('--backup', '-b', device)
+        flat = self.data_files()
+        first = open(os.path.join(self.store, 'dev-current')).read()
+
+        # Blocks written later go into shards, and the flat ones are
+        # still used.
+        f = open(device, 'r+b')
+        f.seek(4096)
+        f.write('x' * 4096)
+        f.close()
+        self.run_command('--backup', '-b', device,
+                         '--directory-layout', 'sharded')
+        self.assertEqual(self.data_files(), flat)
+        shards = os.path.join(self.store, s3bdbk._SHARD_DIRECTORY)
+        sharded = [name for shard in os.listdir(shards)
+                   for name in os.listdir(os.path.join(shards, shard))]
+        self.assertEqual(len(sharded), 1)
+
+        storage = s3bdbk.make_storage(
+            self.parse_args('--directory-layout', 'sharded'))
+        self.assertEqual(storage.list('dev-data-'), sorted(flat + sharded))
+        self.assertTrue(storage.exists(sharded[0]))
+        self.assertFalse([x for x in os.listdir(self.store)
+                          if x.endswith('.tmp')])
+
+        restored = os.path.join(self.tempdir, 'restored')
+        self.assertEqual(self.run_command('--restore', '-b', restored), 0)
+        self.assertEqual(open(restored, 'rb').read(),
+                         open(device, 'rb').read())
+
+        # Removing the first backup removes the flat block it alone
+        # used.
+        os.remove(os.path.join(self.store, first))
+        self.run_command('--list', '--cleanup')
+        self.assertEqual(len(self.data_files()), 3)
+        self.assertEqual(len(storage.list('dev-data-')), 4)
+
+    def test_simulated_storage(self):
+        device = self.make_device('device', 4)
+        args = self.parse_args('--backup', '-b', device)
+        storage = bench.SimulatedStorage(s3bdbk.make_storage(args))
+        old_stdout = sys.stdout
+        sys.stdout = cStringIO.StringIO()
+        try:
+            s3bdbk.do_backup(args, storage)
+        finally:
+            sys.stdout = old_stdout
+        self.assertEqual(storage.requests['store'], 4 + 2)
+        self.assertEqual(storage.sent, sum(
+                os.path.getsize(os.path.join(self.store, x))
+                for x in os.listdir(self.store)))
+
+        storage = bench.SimulatedStorage(s3bdbk.make_storage(args),
+                                         error_rate=1.0)
+        self.assertRaises(IOError, storage.exists, 'dev-current')
+        self.assertEqual(dict(storage.requests), {'exists': 1})
+
+        # Synthetic devices depend only on their seed.
+        paths = [os.path.join(self.tempdir, 'synthetic%d' % x)
+                 for x in range(3)]
+        for path, seed in zip(paths, [5, 5, 6]):
+            bench.make_device(path, 4096 * 3 + 100, 4096, seed=seed)
+        data = [open(x, 'rb').read() for x in paths]
+        self.assertEqual(data[0], data[1])
+        self.assertNotEqual(data[0], data[2])
+
+    def test_worker_counts(self):
+        # With no workers, nothing would ever be done.
+        old_stderr = sys.stderr
+        sys.stderr = cStringIO.StringIO()
+        try:
+            for option in ['-j', '--upload-jobs', '--prefetch',
+                           '--manifest-jobs', '--part-jobs', '--delete-jobs',
+                           '--hash-jobs']:
+                self.assertRaises(SystemExit, self.parse_args,
+                                  '--list', '--cleanup', option, '0')
+        finally:
+            sys.stderr = old_stderr
+        self.assertEqual(self.parse_args('--list', '--manifest-jobs',
+                                         '3').manifest_jobs, 3)
+
+    def test_job_file(self):
+        job_file = os.path.join(self.tempdir, 'job.ini')
+        f = open(job_file, 'w')
+        f.write('[DEFAULT]\nlimit = 2\ncleanup = yes\n')
+        for name in ['one', 'two']:
+            f.write('[%s]\nblock = %s\ndirectory = %s\n' % (
+                    name, os.path.join(self.tempdir, name),
+                    os.path.join(self.store, name)))
+        f.close()
+
+        old_create_manifest_name = s3bdbk.create_manifest_name
+        hours = iter(range(10))
+        s3bdbk.create_manifest_name = lambda storage: (
+            '%s-manifest-20150101-%02d0000-00000000' % (
+                storage.prefix, next(hours)))
+        try:
+            for seed in range(3):
+                for name in ['one', 'two']:
+                    self.make_device(name, 4, seed=seed)
+                self.assertEqual(self.run_command('--job-file', job_file), 0)
+
+            # A device which cannot be read fails alone, and nothing
+            # is then cleaned up.
+            os.remove(os.path.join(self.tempdir, 'one'))
+            self.make_device('two', 4, seed=3)
+            old_stderr = sys.stderr
+            sys.stderr = cStringIO.StringIO()
+            try:
+                self.assertEqual(self.run_command('--job-file', job_file), 1)
+            finally:
+                sys.stderr = old_stderr
+        finally:
+            s3bdbk.create_manifest_name = old_create_manifest_name
+
+        # The middle backups of both were purged and their blocks
+        # cleaned up, but the blocks of the backup of two purged after
+        # the failure remain.
+        self.assertEqual(len(glob.glob(os.path.join(
+                        self.store, 'one-manifest-*'))), 2)
+        self.assertEqual(len(glob.glob(os.path.join(
+                        self.store, 'two-manifest-*'))), 2)
+        self.assertEqual(len(self.data_files()), 2 * 4 + 3 * 4)
+        restored = os.path.join(self.tempdir, 'restored')
+        self.run_command('--restore', '-b', restored, prefix='two')
+        self.assertEqual(open(restored, 'rb').read(), open(
+                self.make_device('expected', 4, seed=3), 'rb').read())
+
+    def test_shared_pipeline(self):
+        pipeline = s3bdbk.SharedPipeline([2, 2])
+        order = []
+        results = {}
+
+        def run(name, count):
+            def fail(item):
+                if name == 'bad' and item == 3:
+                    raise RuntimeError('failed')
+                order.append(name)
+                return item
+            try:
+                pipeline.run(range(count), [fail, lambda x: None])
+                results[name] = 'ok'
+            except RuntimeError:
+                results[name] = 'error'
+
+        threads = [threading.Thread(target=run, args=x)
+                   for x in [('bad', 100), ('good', 20)]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        pipeline.close()
+        self.assertEqual(results, {'bad': 'error', 'good': 'ok'})
+        self.assertEqual(order.count('good'), 20)
+        self.assertTrue(order.count('bad') < 50)
+
+    def test_scrub(self):
+        device = self.make_device('device', 6)
+        self.run_command('--backup', '-b', device)
+        items = self.load_manifest()
+
+        def scrub(*argv):
+            args = self.parse_args('--scrub', *argv)
+            old_stdout, old_stderr = sys.stdout, sys.stderr
+            sys.stdout = output = cStringIO.StringIO()
+            sys.stderr = errors = cStringIO.StringIO()
+            try:
+                result = s3bdbk.do_scrub(args)
+            finally:
+                sys.stdout, sys.stderr = old_stdout, old_stderr
+            return result, output.getvalue(), errors.getvalue()
+
+        # The sample is random, so pick it here: the blocks about to
+        # be damaged are in it.
+        chosen = set(items[x].name for x in [0, 1, 4])
+        old_sample = random.sample
+        random.sample = lambda population, k: [
+            x for x in population if x in chosen][:k]
+        try:
+            result, output, errors = scrub('--sample', '50%',
+                                           '--bandwidth', '100M')
+        finally:
+            random.sample = old_sample
+        self.assertEqual(result, 0)
+        self.assertTrue('Scrubbed 3 of 6 blocks, 0 errors' in output)
+
+        # Blocks verified recently are skipped, even once damaged.
+        f = open(os.path.join(self.store, items[1].name), 'wb')
+        f.write(s3bdbk.compress_block('x' * 4096))
+        f.close()
+        os.remove(os.path.join(self.store, items[4].name))
+        storage = s3bdbk.make_storage(self.parse_args())
+        verified = s3bdbk.load_verified_blocks(storage, self.parse_args())
+        self.assertEqual(set(verified), chosen)
+        result, output, errors = scrub()
+        self.assertTrue('Scrubbed 3 of 6 blocks, 0 errors' in output)
+        self.assertEqual(result, 0)
+
+        result, output, errors = scrub('--scrub-interval', '0')
+        self.assertEqual(result, 1)
+        self.assertTrue('Scrubbed 6 of 6 blocks, 2 errors' in output)
+        self.assertTrue(("data file '%s' does not exist" % items[4].name)
+                        in errors)
+        # Here the damage also changed the stored size, which is
+        # noticed without reading the block.
+        self.assertTrue(("Stored size mismatch at item '%s'" % items[1].name)
+                        in errors)
+        verified = s3bdbk.load_verified_blocks(storage, self.parse_args())
+        self.assertEqual(sorted(verified), sorted(
+                x.name for x in items if x not in (items[1], items[4])))
+
+    def test_pipeline_error(self):
+        def fail(item):
+            if item == 5:
+                raise RuntimeError('failed')
+            return item
+
+        pipeline = s3bdbk.Pipeline([(fail, 3), (lambda x: None, 2)])
+        self.assertRaises(RuntimeError, pipeline.run, range(100))
+
+
+@unittest.skipIf(boto is None, 'requires boto and moto')
+class S3StorageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.mock = moto.mock_s3()
+        self.mock.start()
+        boto.connect_s3('access', 'secret').create_bucket('bucket')
+
+    def tearDown(self):
+        self.mock.stop()
+
+    def make_storage(self, *argv):
+        args, extra = s3bdbk.make_parser().parse_args(
+            ['--access', 'access', '--secret', 'secret', '--bucket', 'bucket',
+             '--prefix', 'dev'] + list(argv))
+        return s3bdbk.make_storage(args)
+
+    def test_storage(self):
+        storage = self.make_storage('--connections', '2')
+        storage.store('dev-data-1', 'data')
+        self.assertTrue(storage.exists('dev-data-1'))
+        self.assertFalse(storage.exists('dev-data-2'))
+        self.assertEqual(storage.load('dev-data-1'), 'data')
+        self.assertEqual(storage.list_sizes('dev-data-'), {'dev-data-1' : 4})
+
+        # Streams hold their connection until closed, and several can
+        # be open at once.
+        streams = [storage.load_stream('dev-data-1') for i in range(2)]
+        self.assertEqual([x.read() for x in streams], ['data', 'data'])
+        for stream in streams:
+            stream.close()
+
+        self.assertEqual(storage.remove_many(['dev-data-1']), {})
+        self.assertEqual(storage.list('dev-'), [])
+
+    def test_multipart_stream(self):
+        data = os.urandom(3 * s3bdbk._PART_SIZE + 100)
+        storage = self.make_storage('--part-jobs', '3')
+        storage.store_stream('dev-object', cStringIO.StringIO(data))
+        self.assertEqual(storage.load('dev-object'), data)
+
+
 if __name__ == '__main__':
     unittest.main()
     